@@ -0,0 +1,243 @@
+from definitions import *
+from bytecode import assemble
+
+# (values popped, values pushed) for opcodes that only work on the stack top
+STACK_EFFECTS = {
+    PUSH: (0, 1),
+    PUSH_CONST: (0, 1),
+    ADD_IMM: (1, 1),
+    POP: (1, 0),
+    ADD: (2, 1),
+    SUB: (2, 1),
+    MUL: (2, 1),
+    DIV: (2, 1),
+    SWAP: (2, 2),
+    ROT: (3, 3),
+    OVER: (2, 3),
+    FLIP: (2, 2),
+    DECREMENT: (1, 1),
+    INCREMENT: (1, 1),
+    DUMP: (1, 1),
+    DUP: (1, 2),
+}
+
+# Loops whose bounds still move after this many passes over the body are
+# widened, so the analysis always ends
+WIDEN_AFTER = 3
+# and given up on entirely after this many
+MAX_PASSES = 10
+
+def join(a, b):
+    # The range of depths covering both a and b; None is unreachable, and
+    # an upper bound of None means unbounded
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high = None if a[1] is None or b[1] is None else max(a[1], b[1])
+    return min(a[0], b[0]), high
+
+def highest(a, b):
+    return None if a is None or b is None else max(a, b)
+
+class StackAnalysis:
+    # Follows the range of stack depths every instruction can see, relative
+    # to the bottom of its frame, through the whole program without running
+    # it. Every function is summarized once: the deepest its own frame gets,
+    # the deepest the stack gets during a call including further calls, and
+    # whether it leaves through return, which pushes a value in the caller,
+    # or by reaching its end, which pushes nothing in the interpreter and 0
+    # in compiled code. Instructions that may find too few values in their
+    # frame are collected in problems. The program starts with between
+    # depths[0] and depths[1] values on the stack. It can be bytecode or an
+    # instruction list such as tokenize_file returns; only bytecode loaded
+    # from a file has the source positions report() prints.
+    def __init__(self, program, depths=(0, 0)):
+        self.program = assemble(program)
+        self.ops = self.program.ops
+        self.jumps = link(self.ops)
+        self.definitions = {}
+        for i, op in enumerate(self.ops):
+            if op == FUNCTION:
+                self.definitions.setdefault(self.program[i][1], []).append(i)
+
+        # Instruction index -> (certain, message)
+        self.problems = {}
+        # Index of the defining instruction -> summary of a function
+        self.functions = {}
+        # Functions being summarized, with what is assumed about them
+        # meanwhile, and those of them that are called recursively
+        self.active = {}
+        self.recursive = set()
+
+        self.main = {"name": None, "args": 0, "depth": depths[1], "peak": depths[1], "returns": False, "falls": False}
+        end, breaks = self.block(0, len(self.ops), tuple(depths), self.main)
+        self.main["falls"] = end is not None or bool(breaks)
+        for indexes in self.definitions.values():
+            for i in indexes:
+                self.function(i)
+
+    def safe(self):
+        # True when no instruction can run short of values, so the checks
+        # for it can be left out
+        return not self.problems
+
+    def depth(self, index=None):
+        # The most values the frame of the function defined at index, or of
+        # the main program, ever holds, or None when that is unbounded
+        if index is None:
+            return self.main["depth"]
+        return self.function(index)["depth"]
+
+    def peak(self):
+        # The most values the whole stack ever holds, or None when unbounded
+        return self.main["peak"]
+
+    def problem(self, i, certain, message):
+        self.problems[i] = (certain, message)
+
+    def need(self, i, state, n, message="Stack underflow"):
+        low, high = state
+        if low < n:
+            self.problem(i, high is not None and high < n, message)
+            # Past here the values were there
+            low = n
+            if high is not None:
+                high = max(high, n)
+        return low, high
+
+    def function(self, i):
+        if i in self.functions:
+            return self.functions[i]
+        if i in self.active:
+            # A recursive call, which is taken to leave the way the function
+            # has been found to leave so far. How deep it goes is unknown.
+            self.recursive.add(i)
+            return self.active[i]
+        name, argcount = self.program[i][1:]
+        known = set(self.functions)
+        self.active[i] = {"name": name, "args": argcount, "depth": None, "peak": None, "returns": False, "falls": False}
+        while True:
+            summary = {"name": name, "args": argcount, "depth": argcount, "peak": argcount, "returns": False, "falls": False}
+            end, breaks = self.block(i + 2, self.jumps[i], (argcount, argcount), summary)
+            summary["falls"] = end is not None or bool(breaks)
+            assumed = self.active[i]
+            if i not in self.recursive or (summary["returns"], summary["falls"]) == (assumed["returns"], assumed["falls"]):
+                break
+            # Try again with the new ways out, forgetting the functions
+            # summarized under the old ones
+            assumed["returns"] = summary["returns"]
+            assumed["falls"] = summary["falls"]
+            for j in set(self.functions) - known:
+                del self.functions[j]
+        del self.active[i]
+        self.functions[i] = summary
+        return summary
+
+    def call(self, i, state, frame):
+        name = self.program[i][1]
+        indexes = self.definitions.get(name, [])
+        if len(indexes) != 1:
+            # Which definition runs depends on the order things happen in
+            message = "Function {} not found" if not indexes else "Function {} is defined more than once"
+            self.problem(i, not indexes, message.format(name))
+            frame["peak"] = None
+            return 0, None
+        callee = self.function(indexes[0])
+        argcount = callee["args"]
+        low, high = self.need(i, state, argcount, "Not enough arguments for function {}".format(name))
+        if high is not None:
+            frame["peak"] = highest(frame["peak"], None if callee["peak"] is None else high - argcount + callee["peak"])
+        else:
+            frame["peak"] = None
+        if not callee["returns"] and not callee["falls"]:
+            return None
+        low = low - argcount + (0 if callee["falls"] else 1)
+        return low, None if high is None else high - argcount + 1
+
+    def loop(self, i, state, frame):
+        # The state at the condition covers the state the loop is entered
+        # with and every state the body can come back with; the loop is
+        # left from there when the condition fails
+        header = state
+        passes = 0
+        while True:
+            checked = self.need(i, header, 2)
+            end, breaks = self.block(i + 3, self.jumps[i], checked, frame)
+            after = header
+            for back in [end] + breaks:
+                after = join(after, back)
+            if after == header:
+                return checked
+            passes += 1
+            if passes >= MAX_PASSES:
+                after = (0, None)
+            elif passes >= WIDEN_AFTER:
+                # Bounds that still move are given up on, so the range only
+                # ever grows
+                low = 0 if after[0] < header[0] else header[0]
+                high = None if after[1] is None or after[1] > header[1] else header[1]
+                after = (low, high)
+            header = after
+
+    def block(self, start, end, state, frame):
+        # Returns the state at end and the states of the breaks leaving the
+        # block; a state of None means end is not reached
+        ops = self.ops
+        breaks = []
+        i = start
+        while i < end and state is not None:
+            op = ops[i]
+            if op in STACK_EFFECTS:
+                pops, pushes = STACK_EFFECTS[op]
+                message = "Not enough values on the stack to flip" if op == FLIP else "Stack underflow"
+                low, high = self.need(i, state, pops, message)
+                state = (low - pops + pushes, None if high is None else high - pops + pushes)
+            elif op == IF:
+                state = self.need(i, state, 2)
+                inner, inner_breaks = self.block(i + 3, self.jumps[i], state, frame)
+                for after in [inner] + inner_breaks:
+                    state = join(state, after)
+                i = self.jumps[i]
+            elif op == WHILE:
+                state = self.loop(i, state, frame)
+                i = self.jumps[i]
+            elif op == FUNCTION:
+                i = self.jumps[i]
+            elif op == CALL:
+                state = self.call(i, state, frame)
+            elif op == BREAK:
+                breaks.append(state)
+                state = None
+            elif op == RETURN:
+                if frame is self.main:
+                    self.problem(i, True, "Return outside of function")
+                else:
+                    self.need(i, state, 1)
+                    frame["returns"] = True
+                state = None
+            elif op != PROBE:
+                self.problem(i, True, "Unknown opcode: {}".format(self.program[i]))
+                state = (0, None)
+            if state is not None:
+                frame["depth"] = highest(frame["depth"], state[1])
+                frame["peak"] = highest(frame["peak"], state[1])
+            i += 1
+        return state, breaks
+
+    def report(self, file_name=""):
+        lines = []
+        for i in sorted(self.problems):
+            certain, message = self.problems[i]
+            line, column = self.program.position(i)
+            lines.append("{}:{}:{}: {}{}".format(file_name, line, column, "" if certain else "possibly: ", message))
+
+        def bound(n):
+            return "unbounded" if n is None else str(n)
+
+        lines.append("{:<16} {:>10} {:>10}".format("function", "frame", "total"))
+        lines.append("{:<16} {:>10} {:>10}".format("(main)", bound(self.main["depth"]), bound(self.main["peak"])))
+        for i in sorted(self.functions):
+            summary = self.functions[i]
+            lines.append("{:<16} {:>10} {:>10}".format(summary["name"], bound(summary["depth"]), bound(summary["peak"])))
+        return "\n".join(lines)
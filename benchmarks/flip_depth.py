@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from definitions import *
+import interpreter
+
+ITERATIONS = 20000
+DEPTHS = [10, 100, 1000, 10000, 100000]
+
+def flip_program(depth, flips):
+    # depth filler values under an [i, ITERATIONS] loop counter; each
+    # iteration bumps i and, when flips is set, flips the stack twice so the
+    # loop state is restored
+    program = [push(0) for _ in range(depth)]
+    program += [push(0), push(ITERATIONS), while_statement(), is_grt(), do()]
+    program += [swap(), push(1), add(), swap()]
+    if flips:
+        program += [flip(), flip()]
+    program += [end()]
+    return program
+
+def run(program):
+    interpreter.stack = []
+    start = time.perf_counter()
+    interpreter.simulate(program)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    print("{:>8} {:>14}".format("depth", "ns per flip"))
+    for depth in DEPTHS:
+        baseline = run(flip_program(depth, False))
+        flipped = run(flip_program(depth, True))
+        per_flip = (flipped - baseline) / (2 * ITERATIONS) * 1e9
+        print("{:>8} {:>14.1f}".format(depth, per_flip))
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from bytecode import load
+from optimizer import optimize
+import interpreter
+
+GENERATED_FUNCTIONS = 2000
+
+def generate_large(file_name):
+    # Many small functions and calls, so the source is dominated by
+    # tokenizing and code generation rather than by run time
+    with open(file_name, "w") as f:
+        for k in range(GENERATED_FUNCTIONS):
+            f.write("function f{0} 1 begin dup {0} + swap drop return end\n".format(k))
+            f.write("{0} call f{0} drop\n".format(k))
+        f.write("1 .\n")
+
+def best(runs, measure):
+    times = [measure() for _ in range(runs)]
+    return min(times)
+
+def time_tokenize(file_name):
+    start = time.perf_counter()
+    load(file_name)
+    return time.perf_counter() - start
+
+def time_interpret(program):
+    interpreter.stack = []
+    interpreter.call_stack = []
+    interpreter.functions = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        interpreter.simulate(program)
+        return time.perf_counter() - start
+
+def time_compile(program, opt_level, directory):
+    from compiler import Codegen
+    output_file = os.path.join(directory, "a.out")
+    codegen = Codegen(output_file, program, opt_level)
+    return codegen.timings, output_file
+
+def time_binary(output_file):
+    start = time.perf_counter()
+    subprocess.run([output_file], stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def run_benchmark(file_name, runs, opt_level, compile_programs):
+    result = {}
+    result["tokenize"] = best(runs, lambda: time_tokenize(file_name))
+    program, _ = optimize(load(file_name))
+    result["interpret"] = best(runs, lambda: time_interpret(program))
+
+    if compile_programs:
+        with tempfile.TemporaryDirectory() as directory:
+            phases = []
+            for _ in range(runs):
+                timings, output_file = time_compile(program, opt_level, directory)
+                phases.append(timings)
+            for phase in phases[0]:
+                result[phase] = min(timings[phase] for timings in phases)
+            result["run"] = best(runs, lambda: time_binary(output_file))
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    print()
+    print("{:<16} {:<10} {:>10} {:>10} {:>8}".format("benchmark", "phase", "before", "after", "ratio"))
+    for name, phases in results["benchmarks"].items():
+        old = baseline["benchmarks"].get(name, {})
+        for phase, seconds in phases.items():
+            if phase in old and old[phase] > 0:
+                print("{:<16} {:<10} {:>10.4f} {:>10.4f} {:>7.2f}x".format(
+                    name, phase, old[phase], seconds, seconds / old[phase]))
+
+if __name__ == "__main__":
+    runs = 3
+    if "--runs" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1])
+
+    opt_level = 0
+    for arg in sys.argv[1:]:
+        if arg in ("-O0", "-O1", "-O2", "-O3"):
+            opt_level = int(arg[2])
+
+    compile_programs = "--no-comp" not in sys.argv
+    if compile_programs and shutil.which("clang") is None:
+        print("clang not found, skipping the compile and run phases", file=sys.stderr)
+        compile_programs = False
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = [os.path.join(HERE, name) for name in sorted(os.listdir(HERE)) if name.endswith(".slang")]
+        large = os.path.join(directory, "generated.slang")
+        generate_large(large)
+        files.append(large)
+        if "--only" in sys.argv:
+            only = sys.argv[sys.argv.index("--only") + 1]
+            files = [f for f in files if os.path.basename(f) == only + ".slang"]
+
+        results = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "opt_level": opt_level,
+            "runs": runs,
+            "benchmarks": {},
+        }
+        phases = ["tokenize", "interpret", "codegen", "optimize", "emit", "link", "run"]
+        print("{:<16}".format("benchmark") + "".join("{:>10}".format(phase) for phase in phases))
+        for file_name in files:
+            name = os.path.splitext(os.path.basename(file_name))[0]
+            result = run_benchmark(file_name, runs, opt_level, compile_programs)
+            results["benchmarks"][name] = result
+            print("{:<16}".format(name) + "".join(
+                "{:>10.4f}".format(result[phase]) if phase in result else "{:>10}".format("-") for phase in phases))
+
+    if "--json" in sys.argv:
+        with open(sys.argv[sys.argv.index("--json") + 1], "w") as f:
+            json.dump(results, f, indent=2)
+
+    if "--compare" in sys.argv:
+        with open(sys.argv[sys.argv.index("--compare") + 1]) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,204 @@
+import os
+import sys
+import struct
+import marshal
+import hashlib
+from array import array
+from definitions import *
+
+# Literals outside this range are kept in the constant pool
+MIN_INLINE = -(1 << 63)
+MAX_INLINE = (1 << 63) - 1
+
+class Bytecode:
+    def __init__(self):
+        # One opcode and one operand per instruction. The operand is the
+        # literal for PUSH and ADD_IMM, the probe number for PROBE and an index into consts for
+        # PUSH_CONST, CALL and FUNCTION; every other opcode leaves it at 0.
+        self.ops = array('B')
+        self.args = array('q')
+        # Source position of each instruction, 0 when it is not known
+        self.lines = array('i')
+        self.columns = array('i')
+        self.consts = []
+        self.const_index = {}
+
+    def intern(self, value):
+        key = (type(value), value)
+        if key not in self.const_index:
+            self.const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self.const_index[key]
+
+    def append(self, opcode, line=0, column=0):
+        self.lines.append(line)
+        self.columns.append(column)
+        op = opcode[0]
+        if op == ADD_IMM or op == PROBE:
+            self.ops.append(op)
+            self.args.append(opcode[1])
+        elif op == PUSH:
+            if MIN_INLINE <= opcode[1] <= MAX_INLINE:
+                self.ops.append(PUSH)
+                self.args.append(opcode[1])
+            else:
+                self.ops.append(PUSH_CONST)
+                self.args.append(self.intern(opcode[1]))
+        elif op == CALL:
+            self.ops.append(CALL)
+            self.args.append(self.intern(opcode[1]))
+        elif op == FUNCTION:
+            self.ops.append(FUNCTION)
+            self.args.append(self.intern((opcode[1], opcode[2])))
+        else:
+            self.ops.append(op)
+            self.args.append(0)
+
+    def position(self, i):
+        return self.lines[i], self.columns[i]
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, i):
+        op = self.ops[i]
+        if op == PUSH:
+            return push(self.args[i])
+        elif op == PUSH_CONST:
+            return push(self.consts[self.args[i]])
+        elif op == ADD_IMM:
+            return add_imm(self.args[i])
+        elif op == PROBE:
+            return probe(self.args[i])
+        elif op == CALL:
+            return call(self.consts[self.args[i]])
+        elif op == FUNCTION:
+            name, argcount = self.consts[self.args[i]]
+            return function(name, argcount)
+        return (op,)
+
+    def __iter__(self):
+        for i in range(len(self.ops)):
+            yield self[i]
+
+def assemble(program):
+    if isinstance(program, Bytecode):
+        return program
+    bytecode = Bytecode()
+    for opcode in program:
+        bytecode.append(opcode)
+    return bytecode
+
+def load(file_name):
+    # Streams the tokenizer straight into bytecode, so no instruction list
+    # is ever built
+    bytecode = Bytecode()
+    append = bytecode.append
+    for opcode, line, column in tokenize(file_name):
+        append(opcode, line, column)
+    return bytecode
+
+# .slc files: a header identifying the source they were built from, the
+# instruction arrays in little-endian order, then the marshalled constants
+SLC_MAGIC = b"SLC\x01"
+SLC_HEADER = struct.Struct("<4sqq32sQ")
+
+def source_digest(file_name):
+    with open(file_name, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def dump_slc(bytecode, file_name, mtime, size, digest):
+    arrays = [bytecode.ops, bytecode.args, bytecode.lines, bytecode.columns]
+    if sys.byteorder == "big":
+        arrays = [array(x.typecode, x) for x in arrays]
+        for x in arrays:
+            x.byteswap()
+
+    # Write under a temporary name so a concurrent reader never sees half a file
+    temp_name = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(temp_name, "wb") as f:
+        f.write(SLC_HEADER.pack(SLC_MAGIC, mtime, size, digest, len(bytecode)))
+        for x in arrays:
+            x.tofile(f)
+        marshal.dump(bytecode.consts, f)
+    os.replace(temp_name, file_name)
+
+def read_slc(file_name):
+    # Returns (bytecode, mtime, size, digest) for the source it was built from
+    with open(file_name, "rb") as f:
+        header = f.read(SLC_HEADER.size)
+        if len(header) != SLC_HEADER.size:
+            raise Exception("{}: truncated bytecode file".format(file_name))
+        magic, mtime, size, digest, count = SLC_HEADER.unpack(header)
+        if magic != SLC_MAGIC:
+            raise Exception("{}: not a bytecode file for this version of slang".format(file_name))
+
+        bytecode = Bytecode()
+        try:
+            for x in [bytecode.ops, bytecode.args, bytecode.lines, bytecode.columns]:
+                x.fromfile(f, count)
+                if sys.byteorder == "big":
+                    x.byteswap()
+            bytecode.consts = marshal.load(f)
+        except (EOFError, ValueError):
+            raise Exception("{}: truncated bytecode file".format(file_name))
+
+    for i, value in enumerate(bytecode.consts):
+        bytecode.const_index[(type(value), value)] = i
+    return bytecode, mtime, size, digest
+
+def load_program(file_name):
+    # Runs .slc files directly. For sources, reuses the .slc next to them
+    # while it matches the source and rewrites it otherwise.
+    if file_name.endswith(".slc"):
+        return read_slc(file_name)[0]
+
+    slc_name = os.path.splitext(file_name)[0] + ".slc"
+    stat = os.stat(file_name)
+    digest = None
+    try:
+        bytecode, mtime, size, slc_digest = read_slc(slc_name)
+        if mtime == stat.st_mtime_ns and size == stat.st_size:
+            return bytecode
+        # Touched but maybe unchanged, e.g. by a checkout
+        digest = source_digest(file_name)
+        if digest == slc_digest:
+            return bytecode
+    except Exception:
+        pass
+
+    bytecode = load(file_name)
+    try:
+        if digest is None:
+            digest = source_digest(file_name)
+        dump_slc(bytecode, slc_name, stat.st_mtime_ns, stat.st_size, digest)
+    except OSError:
+        # A read-only source tree just means no cached bytecode
+        pass
+    return bytecode
+
+def tail_calls(program, jumps):
+    # Maps each call that is the last thing its function does to whether the
+    # callee's result is dropped: a call before the function's end drops it,
+    # a call before return hands it on. The latter only counts when the
+    # callee always returns a value, as the caller's return would pop one.
+    ops = program.ops
+    always_returns = {}
+    for i, op in enumerate(ops):
+        if op == FUNCTION:
+            name = program.consts[program.args[i]][0]
+            end = jumps[i]
+            returns = ops[end - 1] == RETURN and not any(
+                ops[j] == BREAK and jumps[j] == end for j in range(i + 2, end))
+            # A function defined twice may be either definition at run time
+            always_returns[name] = returns and name not in always_returns
+
+    tails = {}
+    for i in range(len(ops) - 1):
+        if ops[i] != CALL:
+            continue
+        if ops[i + 1] == RETURN and always_returns.get(program.consts[program.args[i]]):
+            tails[i] = False
+        elif ops[i + 1] == END and ops[jumps[i + 1]] == FUNCTION:
+            tails[i] = True
+    return tails
@@ -0,0 +1,123 @@
+import os
+import stat
+import shutil
+import hashlib
+import tempfile
+import llvmlite
+import llvmlite.binding as llvm
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "slang")
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Any change to these files changes the code we emit
+COMPILER_FILES = ["compiler.py", "definitions.py", "bytecode.py", "analyzer.py", "optimizer.py"]
+
+# Computed once per process; a long-running server has to be restarted to
+# pick up a changed compiler
+fingerprint = None
+
+def compiler_fingerprint():
+    global fingerprint
+    if fingerprint is not None:
+        return fingerprint
+    digest = hashlib.sha256()
+    digest.update("{} {} {}".format(CACHE_VERSION, llvmlite.__version__, llvm.llvm_version_info).encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in COMPILER_FILES:
+        with open(os.path.join(here, name), "rb") as f:
+            digest.update(f.read())
+
+    # Identify clang by path and file stats rather than spawning it for --version
+    clang = shutil.which("clang")
+    if clang is not None:
+        stat = os.stat(clang)
+        digest.update("{} {} {}".format(os.path.realpath(clang), stat.st_size, stat.st_mtime_ns).encode())
+    fingerprint = digest.hexdigest()
+    return fingerprint
+
+# Object files of single functions, for incremental builds
+FUNCTIONS_DIR = "functions"
+
+class CompileCache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = os.environ.get("SLANG_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, source, options=()):
+        digest = hashlib.sha256()
+        digest.update(compiler_fingerprint().encode())
+        digest.update(llvm.get_default_triple().encode())
+        digest.update(repr(sorted(options)).encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def functions(self):
+        # The cache of function objects that goes with this one
+        return CompileCache(os.path.join(self.directory, FUNCTIONS_DIR), self.max_size)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, output_file):
+        path = self.path(key)
+        try:
+            shutil.copy2(path, output_file)
+        except FileNotFoundError:
+            return False
+        # Touch the entry so eviction sees it as recently used
+        os.utime(path)
+        return True
+
+    def lookup(self, key):
+        # Returns the path of an entry, or None when there is none. Touching
+        # it keeps it from being evicted before the caller is done with it.
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, key, output_file):
+        if not os.path.exists(output_file):
+            return
+        # Copy under a temporary name and rename so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        os.close(fd)
+        shutil.copy2(output_file, temp_path)
+        os.replace(temp_path, self.path(key))
+
+    def store(self, key, output_file):
+        self.add(key, output_file)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Evicted by a concurrent compile
+                continue
+            # Such as the cache of function objects
+            if not stat.S_ISREG(info.st_mode):
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+            total += info.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import socket
+import signal
+import struct
+
+# Runs slang.py through a server started with "slang.py --serve", which has
+# the backends already loaded. Takes the same arguments as slang.py and
+# falls back to running it directly when no server is listening.
+
+def socket_path():
+    # The same path as server.default_socket_path
+    if "SLANG_SOCKET" in os.environ:
+        return os.environ["SLANG_SOCKET"]
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if not directory:
+        import tempfile
+        directory = os.path.join(tempfile.gettempdir(), "slang-{}".format(os.getuid()))
+    return os.path.join(directory, "slang.sock")
+
+def peer_uid(connection):
+    _, uid, _ = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+def run_locally(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slang.py")
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+def main():
+    args = sys.argv[1:]
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except OSError:
+        run_locally(args)
+
+    # The terminal is only handed to a server run by this user
+    uid = peer_uid(connection)
+    if uid != os.getuid():
+        print("slang: the server on {} belongs to uid {}, not to you".format(socket_path(), uid), file=sys.stderr)
+        sys.exit(1)
+
+    request = json.dumps({"argv": args, "cwd": os.getcwd()}).encode()
+    socket.send_fds(connection, [request], [0, 1, 2])
+
+    pid = None
+    status = 1
+    replies = connection.makefile("r")
+    while True:
+        try:
+            line = replies.readline()
+        except KeyboardInterrupt:
+            # Interrupt the program, then wait for it to report its status
+            if pid is not None:
+                os.kill(pid, signal.SIGINT)
+            continue
+        if not line:
+            break
+        reply = json.loads(line)
+        if "pid" in reply:
+            pid = reply["pid"]
+        elif "status" in reply:
+            status = reply["status"]
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -1,347 +1,899 @@
 import os
+import sys
+import time
+import ctypes
+import shutil
+import tempfile
 import subprocess
 import llvmlite.ir as ir
 import llvmlite.binding as llvm
 from definitions import *
+from bytecode import assemble, tail_calls
+from analyzer import STACK_EFFECTS, StackAnalysis
+
+int8 = ir.IntType(8)
+int32 = ir.IntType(32)
+int64 = ir.IntType(64)
+int8_ptr = int8.as_pointer()
+STACK_SIZE = 1024
+# Bytes of output collected before they are written to stdout
+OUTPUT_BUFFER_SIZE = 1 << 16
+# Room for the longest value dump prints: "-2147483648\n"
+DUMP_WIDTH = 12
+
+CONDITIONS = {
+    IS_EQL: "==",
+    IS_NEQ: "!=",
+    IS_GRT: ">",
+    IS_LSS: "<",
+    IS_GEQ: ">=",
+    IS_LEQ: "<=",
+}
+
+# Symbols of the runtime helpers and their globals, and of Slang functions.
+# Neither can be spelled as a Slang name or clash with the C library.
+RUNTIME_PREFIX = "slang."
+FUNCTION_PREFIX = "slang_fn."
+
+def function_symbol(name):
+    return FUNCTION_PREFIX + name
+
+# Linkers clang can use instead of the system one, fastest first, as the
+# name -fuse-ld takes and the program it runs
+FAST_LINKERS = [("mold", "ld.mold"), ("lld", "ld.lld"), ("gold", "ld.gold")]
+
+# Target machines by optimization level, created once per process
+target_machines = {}
+
+def target_machine(opt_level):
+    if opt_level not in target_machines:
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        # Position independent code links both statically and into the
+        # default PIE executables
+        target = llvm.Target.from_default_triple()
+        target_machines[opt_level] = target.create_target_machine(opt=opt_level, reloc="pic")
+    return target_machines[opt_level]
+
+def find_linker():
+    for name, program in FAST_LINKERS:
+        if shutil.which(program) is not None:
+            return name
+    return None
+
+class Frame:
+    # The operand stack of one LLVM function. The top of the stack is held in
+    # SSA values; whatever lies below them is kept in a memory array of depth
+    # entries, where depth is None once it is only known at run time.
+    def __init__(self, function, codegen, size=None):
+        # The entry block only holds the allocas added by memory()
+        self.function = function
+        self.codegen = codegen
+        # A frame whose deepest point is known and fits the configured stack
+        # size gets an array of exactly that size and no checks
+        self.bounded = size is not None and size <= codegen.stack_size
+        self.size = max(size, 1) if self.bounded else codegen.stack_size
+        self.heap = codegen.growable and not self.bounded
+        self.entry = function.append_basic_block(name="entry")
+        start = function.append_basic_block(name="start")
+        ir.IRBuilder(self.entry).branch(start)
+        self.builder = ir.IRBuilder(start)
+        self.values = []
+        self.depth = 0
+        self.stack = None
+        self.stack_pointer = None
+        self.capacity = None
+        # Nonzero while compiling a loop whose room was reserved up front
+        self.hoisted = 0
+        # The block a function that calls itself as its last step starts
+        # over at, and the phis its arguments arrive in there
+        self.restart = None
+        self.arguments = []
+
+    def memory(self):
+        # Allocated on first use. A growable stack lives on the heap and
+        # self.stack holds the pointer to it, which grow_stack may move.
+        if self.stack is None:
+            codegen = self.codegen
+            builder = ir.IRBuilder(self.entry)
+            builder.position_at_start(self.entry)
+            if self.heap:
+                self.stack = builder.alloca(int32.as_pointer())
+                self.capacity = builder.alloca(int32)
+                size = ir.Constant(int64, self.size * 4)
+                data = builder.call(codegen.runtime("malloc", int8_ptr, [int64]), [size])
+                builder.store(builder.bitcast(data, int32.as_pointer()), self.stack)
+                builder.store(ir.Constant(int32, self.size), self.capacity)
+            else:
+                self.stack = builder.alloca(ir.ArrayType(int32, self.size))
+            self.stack_pointer = builder.alloca(int32)
+            builder.store(ir.Constant(int32, 0), self.stack_pointer)
+        return self.stack
+
+    def slot(self, index):
+        if isinstance(index, int):
+            index = ir.Constant(int32, index)
+        if self.heap:
+            return self.builder.gep(self.builder.load(self.memory()), [index])
+        return self.builder.gep(self.memory(), [ir.Constant(int32, 0), index])
+
+    def checks(self):
+        # A growable stack has to be checked to know when to grow
+        return not self.bounded and (self.codegen.growable or self.codegen.checked)
+
+    def ensure(self, needed):
+        # Makes room for needed entries, growing the stack or stopping the
+        # program when it is full
+        codegen = self.codegen
+        builder = self.builder
+        self.memory()
+        if self.heap:
+            capacity = builder.load(self.capacity)
+        else:
+            capacity = ir.Constant(int32, self.size)
+        with builder.if_then(builder.icmp_signed(">", needed, capacity), likely=False):
+            if self.heap:
+                builder.call(codegen.grow_stack(), [self.stack, self.capacity, needed])
+            else:
+                builder.call(codegen.stack_overflow(), [])
+
+    def check(self, index):
+        # Called before storing to index. Indexes known at compile time that
+        # fit the initial size need no check, and neither does anything in a
+        # loop that reserved its room before starting.
+        if not self.checks():
+            return
+        if isinstance(index, int):
+            if index < self.size:
+                return
+            index = ir.Constant(int32, index)
+        elif self.hoisted:
+            return
+        self.ensure(self.builder.add(index, ir.Constant(int32, 1)))
+
+    def reserve(self, n):
+        # Checks once that n more entries fit above the runtime stack pointer
+        if self.checks() and n > 0:
+            self.memory()
+            stack_pointer = self.builder.load(self.stack_pointer)
+            self.ensure(self.builder.add(stack_pointer, ir.Constant(int32, n)))
+
+    def release(self):
+        # Frees a heap stack before every return of the function, and before
+        # a musttail call, which has to come straight before its return
+        if not self.heap or self.stack is None:
+            return
+        free = self.codegen.runtime("free", ir.VoidType(), [int8_ptr])
+        for block in self.function.blocks:
+            terminator = block.terminator
+            if not isinstance(terminator, ir.Ret):
+                continue
+            position = terminator
+            index = block.instructions.index(terminator)
+            if index > 0:
+                previous = block.instructions[index - 1]
+                if isinstance(previous, ir.CallInstr) and previous.tail == "musttail":
+                    position = previous
+            builder = ir.IRBuilder(block)
+            builder.position_before(position)
+            builder.call(free, [builder.bitcast(builder.load(self.stack), int8_ptr)])
+
+    def forget_depth(self):
+        # Hand the memory depth over to the runtime stack pointer
+        if self.depth is not None:
+            self.memory()
+            self.builder.store(ir.Constant(int32, self.depth), self.stack_pointer)
+            self.depth = None
+
+    def push(self, x):
+        self.values.append(x)
+
+    def pop(self):
+        if self.values:
+            return self.values.pop()
+        if self.depth is not None:
+            if self.depth == 0:
+                raise Exception("Stack underflow")
+            self.depth -= 1
+            return self.builder.load(self.slot(self.depth))
+        stack_pointer = self.builder.sub(self.builder.load(self.stack_pointer), ir.Constant(int32, 1))
+        self.builder.store(stack_pointer, self.stack_pointer)
+        return self.builder.load(self.slot(stack_pointer))
+
+    def peek(self, n=1):
+        if n <= len(self.values):
+            return self.values[-n]
+        n -= len(self.values)
+        if self.depth is not None:
+            if self.depth < n:
+                raise Exception("Stack underflow")
+            return self.builder.load(self.slot(self.depth - n))
+        stack_pointer = self.builder.load(self.stack_pointer)
+        return self.builder.load(self.slot(self.builder.sub(stack_pointer, ir.Constant(int32, n))))
+
+    def flush(self):
+        # Move every SSA value into the memory array
+        if not self.values:
+            return
+        count = len(self.values)
+        if self.depth is not None:
+            self.check(self.depth + count - 1)
+            for x in self.values:
+                self.builder.store(x, self.slot(self.depth))
+                self.depth += 1
+        else:
+            self.memory()
+            stack_pointer = self.builder.load(self.stack_pointer)
+            self.check(self.builder.add(stack_pointer, ir.Constant(int32, count - 1)))
+            for k, x in enumerate(self.values):
+                self.builder.store(x, self.slot(self.builder.add(stack_pointer, ir.Constant(int32, k))))
+            self.builder.store(self.builder.add(stack_pointer, ir.Constant(int32, count)), self.stack_pointer)
+        self.values = []
+
+    def flip(self):
+        if self.depth == 0:
+            if len(self.values) < 2:
+                raise Exception("Not enough values on the stack to flip")
+            self.values[0], self.values[-1] = self.values[-1], self.values[0]
+            return
+        # The bottom is in memory, but if its depth is unknown it may not
+        # hold anything yet
+        if self.depth is None:
+            self.flush()
+        top = self.pop()
+        bottom_ptr = self.slot(0)
+        bottom = self.builder.load(bottom_ptr)
+        self.builder.store(top, bottom_ptr)
+        self.push(bottom)
 
 class Codegen:
-    def __init__(self, output_file, program):
+    def __init__(self, output_file, program, opt_level=0, dump_ir=None,
+                 stack_size=STACK_SIZE, growable=False, checked=True, function_cache=None,
+                 static=True, linker=None):
+        self.opt_level = opt_level
+        self.dump_ir = dump_ir
+        # Linking statically makes executables that run anywhere, linking
+        # dynamically is faster. The linker is a name for clang's -fuse-ld,
+        # "ld" for the system one, or None for the fastest one installed.
+        self.static = static
+        self.linker = find_linker() if linker is None else linker
+        # Entries in each function's operand stack; a growable stack starts
+        # at this size and doubles when full
+        self.stack_size = stack_size
+        self.growable = growable
+        self.checked = checked
+        self.program = assemble(program)
+        self.jumps = link(self.program.ops)
+        self.tails = tail_calls(self.program, self.jumps)
         self.module = ir.Module(name=__file__)
         self.module.triple = llvm.get_default_triple()
-        self.builder = None
+        self.main_module = self.module
         self.functions = {}
-        self.main_func = ir.Function(self.module, ir.FunctionType(ir.IntType(32), []), name="main")
-        self.block = self.main_func.append_basic_block(name="entry")
-        self.builder = ir.IRBuilder(self.block)
+        # With a function cache every function defined at the top level is
+        # built in a module of its own, and its object file is cached under
+        # a key derived from its code. These hold (key, module) of the
+        # functions that have to be built and the object files of those
+        # found in the cache.
+        self.function_cache = function_cache
+        self.function_modules = []
+        self.cached_objects = []
+        # Seconds spent in each phase of the build
+        self.timings = {}
+        self.main_func = ir.Function(self.module, ir.FunctionType(int32, []), name="main")
+        # Frames whose deepest point is known are sized to fit it exactly
+        self.analysis = StackAnalysis(self.program)
+        self.frame = Frame(self.main_func, self, self.analysis.depth())
 
-        # Array to act as stack
-        self.stack_type = ir.ArrayType(ir.IntType(32), 1024)
-        self.stack = self.builder.alloca(self.stack_type)
-        self.stack_pointer = self.builder.alloca(ir.IntType(32))
-        self.builder.store(ir.Constant(ir.IntType(32), 0), self.stack_pointer)
+        # Compile the main program
+        start = time.perf_counter()
+        self.compile(self.frame, 0, len(self.program))
 
-        # Declare printf once
-        printf_ty = ir.FunctionType(ir.IntType(32), [ir.PointerType(ir.IntType(8))], var_arg=True)
-        self.printf = ir.Function(self.module, printf_ty, name="printf")
+        # Functions from the cache may use any of the helpers
+        if self.function_cache is not None:
+            self.dump_function()
+            self.stack_overflow()
+            if self.growable:
+                self.grow_stack()
 
-        # Compile the main program
-        self.compile(program)
+        # Return 0 from main once the last output is written
+        if not self.frame.builder.block.is_terminated:
+            if self.buffers_output():
+                self.frame.builder.call(self.flush_output(), [])
+            self.frame.builder.ret(ir.Constant(int32, 0))
+        self.frame.release()
+        self.timings["codegen"] = time.perf_counter() - start
 
-        # Return 0 from main
-        self.builder.ret(ir.Constant(ir.IntType(32), 0))
+        # Without an output file the module is only built, e.g. for run_jit
+        if output_file is not None:
+            self.compile_to_executable(output_file)
 
-        self.compile_to_executable(output_file)
+    def runtime(self, name, return_type, arg_types):
+        # Declares a C library function the first time it is needed
+        if name in self.module.globals:
+            return self.module.globals[name]
+        return ir.Function(self.module, ir.FunctionType(return_type, arg_types), name=name)
 
-    def pop_stack(self):
-        stack_pointer = self.builder.load(self.stack_pointer)
-        stack_pointer = self.builder.sub(stack_pointer, ir.Constant(ir.IntType(32), 1))
-        self.builder.store(stack_pointer, self.stack_pointer)
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), stack_pointer])
-        return self.builder.load(ptr)
+    def helper(self, name, function_type, build):
+        # Returns the runtime helper called name, having build define it the
+        # first time. Helpers are defined in the main module; a module that
+        # holds a single function declares them and the linker finds them.
+        name = RUNTIME_PREFIX + name
+        main = self.main_module
+        if name not in main.globals:
+            function = ir.Function(main, function_type, name=name)
+            if self.function_cache is None:
+                function.linkage = "internal"
+            module = self.module
+            self.module = main
+            try:
+                build(function)
+            finally:
+                self.module = module
+        if name in self.module.globals:
+            return self.module.globals[name]
+        return ir.Function(self.module, function_type, name=name)
 
-    def copy_pop(self, offset=-1):
-        stack_pointer = self.builder.load(self.stack_pointer)
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), self.builder.add(stack_pointer, ir.Constant(ir.IntType(32), offset))])
-        return self.builder.load(ptr)
+    def buffers_output(self):
+        # A function taken from the cache may dump without this build
+        # knowing, so then the buffer is always flushed
+        return self.function_cache is not None or RUNTIME_PREFIX + "flush_output" in self.main_module.globals
 
-    def push_stack(self, x):
-        stack_pointer = self.builder.load(self.stack_pointer)
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), stack_pointer])
-        self.builder.store(x, ptr)
-        self.builder.store(self.builder.add(stack_pointer, ir.Constant(ir.IntType(32), 1)), self.stack_pointer)
-
-    def pop_bottom(self):
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-        return self.builder.load(ptr)
-
-    def push_bottom(self, x):
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-        self.builder.store(x, ptr)
-
-    def evaluate_condition(self, condition_opcode, builder, pop_stack, copy_pop):
-        if condition_opcode[0] == IS_EQL:
-            return builder.icmp_signed("==", copy_pop(), copy_pop(-2))
-        elif condition_opcode[0] == IS_NEQ:
-            return builder.icmp_signed("!=", copy_pop(), copy_pop(-2))
-        elif condition_opcode[0] == IS_GRT:
-            return builder.icmp_signed(">", copy_pop(), copy_pop(-2))
-        elif condition_opcode[0] == IS_LSS:
-            return builder.icmp_signed("<", copy_pop(), copy_pop(-2))
-        elif condition_opcode[0] == IS_GEQ:
-            return builder.icmp_signed(">=", copy_pop(), copy_pop(-2))
-        elif condition_opcode[0] == IS_LEQ:
-            return builder.icmp_signed("<=", copy_pop(), copy_pop(-2))
-        else:
-            raise Exception("Unknown condition opcode: {}".format(condition_opcode))
+    def stack_overflow(self):
+        return self.helper("stack_overflow", ir.FunctionType(ir.VoidType(), []), self.build_stack_overflow)
 
-    def print_stack_top(self):
-        stack_pointer = self.builder.load(self.stack_pointer)
-        ptr = self.builder.gep(self.stack, [ir.Constant(ir.IntType(32), 0), self.builder.sub(stack_pointer, ir.Constant(ir.IntType(32), 1))])
-        value = self.builder.load(ptr)
-        format_str = "%d\n\0"
-        c_format_str = ir.Constant(ir.ArrayType(ir.IntType(8), len(format_str)), bytearray(format_str.encode("utf8")))
-        format_str_ptr = self.builder.alloca(c_format_str.type)
-        self.builder.store(c_format_str, format_str_ptr)
-        format_str_ptr = self.builder.bitcast(format_str_ptr, ir.PointerType(ir.IntType(8)))
-        self.builder.call(self.printf, [format_str_ptr, value])
-
-    def compile_to_executable(self, output_file):  
-        with open("temp.ll", "w") as f:
-            f.write(str(self.module))
-
-        # Compile to object file
-        subprocess.run(["clang", "-c", "temp.ll", "-o", "temp.o"])
-    
-        # Link to create executable
-        subprocess.run(["clang", "-static", "temp.o", "-o", output_file])
-
-        # Clean up
-        os.remove("temp.ll")
-        os.remove("temp.o")
-
-    def extract_block(self, program, start_index):
-        block = []
+    def build_stack_overflow(self, function):
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+
+        text = bytearray(b"Stack overflow\n")
+        message = ir.GlobalVariable(self.module, ir.ArrayType(ir.IntType(8), len(text)), name=RUNTIME_PREFIX + "stack_overflow_message")
+        message.global_constant = True
+        message.linkage = "internal"
+        message.initializer = ir.Constant(message.type.pointee, text)
+
+        # Output printed so far comes before the message
+        if self.buffers_output():
+            builder.call(self.flush_output(), [])
+        write = self.runtime("write", int64, [int32, int8_ptr, int64])
+        builder.call(write, [ir.Constant(int32, 2), builder.bitcast(message, int8_ptr), ir.Constant(int64, len(text))])
+        builder.call(self.runtime("exit", ir.VoidType(), [int32]), [ir.Constant(int32, 1)])
+        builder.unreachable()
+
+    def grow_stack(self):
+        # grow_stack(stack, capacity, needed) reallocates *stack to at least
+        # needed entries, doubling it when that is more
+        function_type = ir.FunctionType(ir.VoidType(), [int32.as_pointer().as_pointer(), int32.as_pointer(), int32])
+        return self.helper("grow_stack", function_type, self.build_grow_stack)
+
+    def build_grow_stack(self, function):
+        stack_type = int32.as_pointer()
+        stack, capacity, needed = function.args
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+
+        doubled = builder.mul(builder.load(capacity), ir.Constant(int32, 2))
+        size = builder.select(builder.icmp_signed(">", needed, doubled), needed, doubled)
+        realloc = self.runtime("realloc", int8_ptr, [int8_ptr, int64])
+        data = builder.call(realloc, [builder.bitcast(builder.load(stack), int8_ptr),
+                                      builder.mul(builder.sext(size, int64), ir.Constant(int64, 4))])
+        with builder.if_then(builder.icmp_unsigned("==", data, ir.Constant(int8_ptr, None)), likely=False):
+            builder.call(self.stack_overflow(), [])
+        builder.store(builder.bitcast(data, stack_type), stack)
+        builder.store(size, capacity)
+        builder.ret_void()
+
+    def evaluate_condition(self, frame, i):
+        condition = self.program.ops[i + 1]
+        if condition not in CONDITIONS:
+            raise Exception("Unknown condition opcode: {}".format(self.program[i + 1]))
+        return frame.builder.icmp_signed(CONDITIONS[condition], frame.peek(1), frame.peek(2))
+
+    def output_buffer(self):
+        # Returns the global buffer dump writes into and its fill level
+        buffer = RUNTIME_PREFIX + "output_buffer"
+        length = RUNTIME_PREFIX + "output_length"
+        if buffer not in self.module.globals:
+            for name, value_type in [(buffer, ir.ArrayType(int8, OUTPUT_BUFFER_SIZE)), (length, int32)]:
+                variable = ir.GlobalVariable(self.module, value_type, name=name)
+                variable.linkage = "internal"
+                variable.initializer = ir.Constant(value_type, None)
+        return self.module.globals[buffer], self.module.globals[length]
+
+    def flush_output(self):
+        # flush_output() writes the buffer to stdout, retrying short writes
+        return self.helper("flush_output", ir.FunctionType(ir.VoidType(), []), self.build_flush_output)
+
+    def build_flush_output(self, function):
+        buffer, length = self.output_buffer()
+        entry = function.append_basic_block(name="entry")
+        loop = function.append_basic_block(name="loop")
+        done = function.append_basic_block(name="done")
+        builder = ir.IRBuilder(entry)
+        total = builder.sext(builder.load(length), int64)
+        builder.branch(loop)
+
+        builder.position_at_end(loop)
+        written = builder.phi(int64)
+        written.add_incoming(ir.Constant(int64, 0), entry)
+        more = builder.icmp_signed("<", written, total)
+        with builder.if_then(more):
+            start = builder.gep(buffer, [ir.Constant(int32, 0), written])
+            write = self.runtime("write", int64, [int32, int8_ptr, int64])
+            count = builder.call(write, [ir.Constant(int32, 1), start, builder.sub(total, written)])
+            # Give up on errors rather than spin
+            with builder.if_then(builder.icmp_signed("<=", count, ir.Constant(int64, 0)), likely=False):
+                builder.branch(done)
+            written.add_incoming(builder.add(written, count), builder.block)
+            builder.branch(loop)
+        builder.branch(done)
+
+        builder.position_at_end(done)
+        builder.store(ir.Constant(int32, 0), length)
+        builder.ret_void()
+
+    def dump_function(self):
+        # dump(value) formats value and a newline into the output buffer,
+        # flushing it first when they might not fit
+        return self.helper("dump", ir.FunctionType(ir.VoidType(), [int32]), self.build_dump)
+
+    def build_dump(self, function):
+        buffer, length = self.output_buffer()
+        entry = function.append_basic_block(name="entry")
+        count_block = function.append_basic_block(name="count")
+        write_block = function.append_basic_block(name="write")
+        digits_block = function.append_basic_block(name="digits")
+        done = function.append_basic_block(name="done")
+        builder = ir.IRBuilder(entry)
+        ten = ir.Constant(int64, 10)
+
+        full = builder.icmp_signed(">", builder.load(length), ir.Constant(int32, OUTPUT_BUFFER_SIZE - DUMP_WIDTH))
+        with builder.if_then(full, likely=False):
+            builder.call(self.flush_output(), [])
+        start = builder.load(length)
+
+        # Working in 64 bits lets the most negative value be negated
+        number = builder.sext(function.args[0], int64)
+        negative = builder.icmp_signed("<", number, ir.Constant(int64, 0))
+        number = builder.select(negative, builder.neg(number), number)
+        before = builder.block
+        builder.branch(count_block)
+
+        # Count the digits, so they can be written backwards in place
+        builder.position_at_end(count_block)
+        digits = builder.phi(int32)
+        digits.add_incoming(ir.Constant(int32, 1), before)
+        rest = builder.phi(int64)
+        rest.add_incoming(number, before)
+        digits.add_incoming(builder.add(digits, ir.Constant(int32, 1)), count_block)
+        rest.add_incoming(builder.udiv(rest, ten), count_block)
+        builder.cbranch(builder.icmp_unsigned(">=", rest, ten), count_block, write_block)
+
+        # The sign goes first; without one the first digit overwrites it
+        builder.position_at_end(write_block)
+        builder.store(ir.Constant(int8, ord("-")), builder.gep(buffer, [ir.Constant(int32, 0), start]))
+        end = builder.add(builder.add(start, builder.zext(negative, int32)), digits)
+        builder.store(ir.Constant(int8, ord("\n")), builder.gep(buffer, [ir.Constant(int32, 0), end]))
+        builder.branch(digits_block)
+
+        builder.position_at_end(digits_block)
+        position = builder.phi(int32)
+        position.add_incoming(end, write_block)
+        rest = builder.phi(int64)
+        rest.add_incoming(number, write_block)
+        position_next = builder.sub(position, ir.Constant(int32, 1))
+        digit = builder.trunc(builder.urem(rest, ten), int8)
+        builder.store(builder.add(digit, ir.Constant(int8, ord("0"))), builder.gep(buffer, [ir.Constant(int32, 0), position_next]))
+        rest_next = builder.udiv(rest, ten)
+        position.add_incoming(position_next, digits_block)
+        rest.add_incoming(rest_next, digits_block)
+        builder.cbranch(builder.icmp_unsigned("!=", rest_next, ir.Constant(int64, 0)), digits_block, done)
+
+        builder.position_at_end(done)
+        builder.store(builder.add(end, ir.Constant(int32, 1)), length)
+        builder.ret_void()
+
+    def print_stack_top(self, frame):
+        frame.builder.call(self.dump_function(), [frame.peek()])
+
+    def target_machine(self):
+        return target_machine(self.opt_level)
+
+    def optimized_module(self, target_machine, source=None):
+        # Optimizes the main module, or source when given
+        dump_ir = self.dump_ir if source is None else None
+        if source is None:
+            source = self.main_module
+        if dump_ir is not None:
+            with open(dump_ir + ".ll", "w") as f:
+                f.write(str(source))
+
+        module = llvm.parse_assembly(str(source))
+        module.verify()
+
+        # The default -O1..-O3 pipelines include mem2reg, instcombine, GVN,
+        # the loop passes and the inliner
+        if self.opt_level > 0:
+            tuning = llvm.create_pipeline_tuning_options(speed_level=self.opt_level)
+            pass_builder = llvm.create_pass_builder(target_machine, tuning)
+            pass_builder.getModulePassManager().run(module, pass_builder)
+
+        if dump_ir is not None:
+            with open(dump_ir + ".opt.ll", "w") as f:
+                f.write(str(module))
+        return module
+
+    def compile_to_executable(self, output_file):
+        # Intermediate files go in a private directory, so concurrent
+        # compiles never overwrite each other's
+        with tempfile.TemporaryDirectory(prefix="slang-") as directory:
+            # The main module, then every function built in a module of its own
+            sources = [None] + [module for _, module in self.function_modules]
+            object_files = [os.path.join(directory, "module{}.o".format(n)) for n in range(len(sources))]
+
+            start = time.perf_counter()
+            target_machine = self.target_machine()
+            modules = [self.optimized_module(target_machine, source) for source in sources]
+            self.timings["optimize"] = time.perf_counter() - start
+
+            # Emit object code straight from the optimized modules
+            start = time.perf_counter()
+            for module, object_file in zip(modules, object_files):
+                with open(object_file, "wb") as f:
+                    f.write(target_machine.emit_object(module))
+            for (key, _), object_file in zip(self.function_modules, object_files[1:]):
+                self.function_cache.add(key, object_file)
+            if self.function_modules:
+                self.function_cache.evict()
+            self.timings["emit"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.link(object_files + self.cached_objects, output_file)
+            self.timings["link"] = time.perf_counter() - start
+
+    def link(self, object_files, output_file):
+        # clang only drives the linker here, adding the C runtime and libc
+        command = ["clang"]
+        if self.static:
+            command.append("-static")
+        if self.linker is not None and self.linker != "ld":
+            command.append("-fuse-ld={}".format(self.linker))
+        result = subprocess.run(command + object_files + ["-o", output_file])
+        if result.returncode != 0:
+            raise Exception("Linking {} failed with exit status {}".format(output_file, result.returncode))
+
+    def run_jit(self):
+        target_machine = self.target_machine()
+        module = self.optimized_module(target_machine)
+        engine = llvm.create_mcjit_compiler(module, target_machine)
+        engine.finalize_object()
+
+        main = ctypes.CFUNCTYPE(ctypes.c_int)(engine.get_function_address("main"))
+        # The program writes straight to the stdout file descriptor, so
+        # anything Python still holds for stdout has to go first
+        sys.stdout.flush()
+        return main()
+
+    def block_effect(self, start, end):
+        # Returns (net change, lowest depth reached, touches the bottom,
+        # highest depth reached) for the instructions in [start, end) relative
+        # to the depth on entry, or None when the effect is only known at run
+        # time
+        ops = self.program.ops
         depth = 0
-        i = start_index
-        while i < len(program):
-            opcode = program[i]
-            if opcode[0] in [IF, WHILE, FUNCTION]:
-                depth += 1
-            elif opcode[0] == END:
-                if depth == 0:
-                    break
-                depth -= 1
-            block.append(opcode)
+        lowest = 0
+        highest = 0
+        bottom = False
+        i = start
+        while i < end:
+            op = ops[i]
+            if op in STACK_EFFECTS:
+                pops, pushes = STACK_EFFECTS[op]
+                lowest = min(lowest, depth - pops)
+                depth += pushes - pops
+                highest = max(highest, depth)
+                bottom = bottom or op == FLIP
+            elif op == WHILE or op == IF:
+                lowest = min(lowest, depth - 2)
+                inner = self.block_effect(i + 3, self.jumps[i])
+                if inner is None or inner[0] != 0:
+                    return None
+                lowest = min(lowest, depth + inner[1])
+                highest = max(highest, depth + inner[3])
+                bottom = bottom or inner[2]
+                i = self.jumps[i]
+            elif op == CALL:
+                name = self.program[i][1]
+                if name not in self.functions:
+                    return None
+                argcount = len(self.functions[name].args)
+                lowest = min(lowest, depth - argcount)
+                depth += 1 - argcount
+                highest = max(highest, depth)
+            elif op == FUNCTION:
+                i = self.jumps[i]
+            elif op == BREAK:
+                break
+            elif op == RETURN:
+                # Control never reaches the end of the block
+                return 0, min(lowest, depth - 1), bottom, highest
+            else:
+                return None
             i += 1
-        return block, i
+        return depth, lowest, bottom, highest
 
-    def compile_function(self, name, body, argcount):
-        func_type = ir.FunctionType(ir.IntType(32), [ir.IntType(32)] * argcount)
-        function = ir.Function(self.module, func_type, name=name)
+    def keeps_values(self, frame, start, end):
+        # True when a block can run with the stack top kept in SSA values:
+        # it leaves the depth unchanged, only reaches into values it was given
+        # and only touches the bottom when the bottom is statically located
+        effect = self.block_effect(start, end)
+        if effect is None:
+            return False
+        net, lowest, bottom, _ = effect
+        if net != 0 or -lowest > len(frame.values):
+            return False
+        return not bottom or frame.depth is not None
+
+    def compile_while(self, frame, i):
+        builder = frame.builder
+        start = i + 3
+        end = self.jumps[i]
+        condition_block = builder.append_basic_block(name="condition")
+        loop_block = builder.append_basic_block(name="loop")
+        end_block = builder.append_basic_block(name="end")
+
+        if self.keeps_values(frame, start, end):
+            # Every value is carried around the loop in a phi
+            entry_block = builder.block
+            builder.branch(condition_block)
+            builder.position_at_end(condition_block)
+            phis = []
+            for x in frame.values:
+                phi = builder.phi(int32)
+                phi.add_incoming(x, entry_block)
+                phis.append(phi)
+            frame.values = list(phis)
+            truth = self.evaluate_condition(frame, i)
+            builder.cbranch(truth, loop_block, end_block)
+            builder.position_at_end(loop_block)
+            self.compile(frame, start, end)
+            if not builder.block.is_terminated:
+                for phi, x in zip(phis, frame.values):
+                    phi.add_incoming(x, builder.block)
+                builder.branch(condition_block)
+            frame.values = list(phis)
+        else:
+            effect = self.block_effect(start, end)
+            frame.flush()
+            bounded = effect is not None and effect[0] == 0
+            depth = frame.depth if bounded else None
+            frame.forget_depth()
+            # A loop that leaves the depth unchanged never goes further than
+            # its highest point above the depth it started at, so that room
+            # is checked once here instead of on every store in the loop
+            if bounded:
+                frame.reserve(effect[3])
+            builder.branch(condition_block)
+            builder.position_at_end(condition_block)
+            truth = self.evaluate_condition(frame, i)
+            builder.cbranch(truth, loop_block, end_block)
+            builder.position_at_end(loop_block)
+            if bounded:
+                frame.hoisted += 1
+            self.compile(frame, start, end)
+            if not builder.block.is_terminated:
+                frame.flush()
+                builder.branch(condition_block)
+            if bounded:
+                frame.hoisted -= 1
+            frame.values = []
+            frame.depth = depth
+        builder.position_at_end(end_block)
+
+    def compile_if(self, frame, i):
+        builder = frame.builder
+        start = i + 3
+        end = self.jumps[i]
+        then_block = builder.append_basic_block(name="then")
+        merge_block = builder.append_basic_block(name="endif")
+
+        if self.keeps_values(frame, start, end):
+            truth = self.evaluate_condition(frame, i)
+            entry_block = builder.block
+            builder.cbranch(truth, then_block, merge_block)
+            builder.position_at_end(then_block)
+            saved = list(frame.values)
+            self.compile(frame, start, end)
+            if builder.block.is_terminated:
+                frame.values = saved
+                builder.position_at_end(merge_block)
+                return
+            then_end = builder.block
+            then_values = frame.values
+            builder.branch(merge_block)
+            builder.position_at_end(merge_block)
+            frame.values = []
+            for before, after in zip(saved, then_values):
+                if before is after:
+                    frame.values.append(before)
+                else:
+                    phi = builder.phi(int32)
+                    phi.add_incoming(before, entry_block)
+                    phi.add_incoming(after, then_end)
+                    frame.values.append(phi)
+        else:
+            effect = self.block_effect(start, end)
+            frame.flush()
+            depth = frame.depth if effect is not None and effect[0] == 0 else None
+            frame.forget_depth()
+            truth = self.evaluate_condition(frame, i)
+            builder.cbranch(truth, then_block, merge_block)
+            builder.position_at_end(then_block)
+            self.compile(frame, start, end)
+            if not builder.block.is_terminated:
+                frame.flush()
+                builder.branch(merge_block)
+            builder.position_at_end(merge_block)
+            frame.values = []
+            frame.depth = depth
+
+    def callee(self, name):
+        # The function called name as seen from the module being built
+        func = self.functions[name]
+        if func.module is self.module:
+            return func
+        if func.name in self.module.globals:
+            return self.module.globals[func.name]
+        return ir.Function(self.module, func.function_type, name=func.name)
+
+    def function_key(self, name, start, end, argcount):
+        # Everything the code of a function depends on: its own code and the
+        # signatures of the functions it calls that are defined elsewhere
+        ops = self.program.ops
+        code = [self.program[i] for i in range(start, end)]
+        defined = set(self.program[i][1] for i in range(start, end) if ops[i] == FUNCTION)
+        callees = {}
+        for i in range(start, end):
+            if ops[i] == CALL:
+                callee = self.program[i][1]
+                if callee not in defined and callee in self.functions:
+                    callees[callee] = len(self.functions[callee].args)
+        source = repr((name, argcount, code, sorted(callees.items()))).encode()
+        options = ["-O{}".format(self.opt_level), "stack={}".format(self.stack_size),
+                   "depth={}".format(self.analysis.depth(start - 2)),
+                   "growable={}".format(self.growable), "checked={}".format(self.checked)]
+        return self.function_cache.key(source, options)
+
+    def declare_function(self, name, argcount):
+        self.functions[name] = ir.Function(self.module, ir.FunctionType(int32, [int32] * argcount), name=function_symbol(name))
+
+    def compile_function(self, name, start, end, argcount):
+        if self.function_cache is not None and self.module is self.main_module:
+            key = self.function_key(name, start, end, argcount)
+            object_file = self.function_cache.lookup(key)
+            if object_file is not None:
+                self.cached_objects.append(object_file)
+                # The object also defines the functions defined inside it
+                self.declare_function(name, argcount)
+                for i in range(start, end):
+                    if self.program.ops[i] == FUNCTION:
+                        self.declare_function(*self.program[i][1:])
+                return
+            module = ir.Module(name=name)
+            module.triple = self.main_module.triple
+            self.function_modules.append((key, module))
+            self.module = module
+            try:
+                self.build_function(name, start, end, argcount)
+            finally:
+                self.module = self.main_module
+        else:
+            self.build_function(name, start, end, argcount)
+
+    def build_function(self, name, start, end, argcount):
+        func_type = ir.FunctionType(int32, [int32] * argcount)
+        function = ir.Function(self.module, func_type, name=function_symbol(name))
         self.functions[name] = function
-        block = function.append_basic_block(name="entry")
-        builder = ir.IRBuilder(block)
-        stack_type = ir.ArrayType(ir.IntType(32), 1024)
-        stack = builder.alloca(stack_type)
-        stack_pointer = builder.alloca(ir.IntType(32))
-        builder.store(ir.Constant(ir.IntType(32), 0), stack_pointer)
-
-        def pop_stack():
-            sp = builder.load(stack_pointer)
-            sp = builder.sub(sp, ir.Constant(ir.IntType(32), 1))
-            builder.store(sp, stack_pointer)
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), sp])
-            return builder.load(ptr)
-
-        def push_stack(x):
-            sp = builder.load(stack_pointer)
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), sp])
-            builder.store(x, ptr)
-            builder.store(builder.add(sp, ir.Constant(ir.IntType(32), 1)), stack_pointer)
-
-        def copy_pop(offset=-1):
-            sp = builder.load(stack_pointer)
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), builder.add(sp, ir.Constant(ir.IntType(32), offset))])
-            return builder.load(ptr)
-
-        def push_bottom(x):
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-            builder.store(x, ptr)
-
-        def pop_bottom():
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-            return builder.load(ptr)
-
-        def print_stack_top():
-            sp = builder.load(stack_pointer)
-            ptr = builder.gep(stack, [ir.Constant(ir.IntType(32), 0), builder.sub(sp, ir.Constant(ir.IntType(32), 1))])
-            value = builder.load(ptr)
-            format_str = "%d\n\0"
-            c_format_str = ir.Constant(ir.ArrayType(ir.IntType(8), len(format_str)), bytearray(format_str.encode("utf8")))
-            format_str_ptr = builder.alloca(c_format_str.type)
-            builder.store(c_format_str, format_str_ptr)
-            format_str_ptr = builder.bitcast(format_str_ptr, ir.PointerType(ir.IntType(8)))
-            builder.call(self.printf, [format_str_ptr, value])
-
-        i = 0
-        while i < len(body):
-            opcode = body[i]
-            if opcode[0] == PUSH:
-                push_stack(ir.Constant(ir.IntType(32), opcode[1]))
-            elif opcode[0] == POP:
-                pop_stack()
-            elif opcode[0] == ADD:
-                push_stack(builder.add(pop_stack(), pop_stack()))
-            elif opcode[0] == OVER:
-                push_stack(copy_pop(-2))
-            elif opcode[0] == SUB:
-                push_stack(builder.sub(pop_stack(), pop_stack()))
-            elif opcode[0] == MUL:
-                push_stack(builder.mul(pop_stack(), pop_stack()))
-            elif opcode[0] == FLIP:
-                top = pop_stack()
-                bottom = pop_bottom()
-                push_bottom(top)
-                push_stack(bottom)
-            elif opcode[0] == DIV:
-                push_stack(builder.sdiv(pop_stack(), pop_stack()))
-            elif opcode[0] == SWAP:
-                top = pop_stack()
-                second = pop_stack()
-                push_stack(top)
-                push_stack(second)
-            elif opcode[0] == ROT:
-                top = pop_stack()
-                second = pop_stack()
-                third = pop_stack()
-                push_stack(top)
-                push_stack(third)
-                push_stack(second)
-            elif opcode[0] == DUMP:
-                print_stack_top()
-            elif opcode[0] == DUP:
-                push_stack(copy_pop())
-            elif opcode[0] == BREAK:
+        frame = Frame(function, self, self.analysis.depth(start - 2))
+
+        # The first argument is the caller's top of stack, and it ends up at
+        # the bottom of the callee's stack, as in the interpreter
+        frame.values = list(function.args)
+        if any(self.tails.get(i) and self.program[i][1] == name for i in range(start, end)):
+            frame.restart = frame.builder.block
+            frame.arguments = [frame.builder.phi(int32) for _ in function.args]
+            for phi, argument in zip(frame.arguments, function.args):
+                phi.add_incoming(argument, frame.entry)
+            frame.values = list(frame.arguments)
+        self.compile(frame, start, end)
+        if not frame.builder.block.is_terminated:
+            frame.builder.ret(ir.Constant(int32, 0))
+        frame.release()
+
+    def compile(self, frame, start, end):
+        builder = frame.builder
+        ops = self.program.ops
+        i = start
+        while i < end:
+            op = ops[i]
+            if op == PUSH or op == PUSH_CONST:
+                frame.push(ir.Constant(int32, self.program[i][1]))
+            elif op == SWAP:
+                top = frame.pop()
+                second = frame.pop()
+                frame.push(top)
+                frame.push(second)
+            elif op == ROT:
+                top = frame.pop()
+                second = frame.pop()
+                third = frame.pop()
+                frame.push(top)
+                frame.push(third)
+                frame.push(second)
+            elif op == POP:
+                frame.pop()
+            elif op == ADD:
+                frame.push(builder.add(frame.pop(), frame.pop()))
+            elif op == ADD_IMM:
+                frame.push(builder.add(frame.pop(), ir.Constant(int32, self.program[i][1])))
+            elif op == FLIP:
+                frame.flip()
+            elif op == OVER:
+                frame.push(frame.peek(2))
+            elif op == SUB:
+                frame.push(builder.sub(frame.pop(), frame.pop()))
+            elif op == MUL:
+                frame.push(builder.mul(frame.pop(), frame.pop()))
+            elif op == DIV:
+                frame.push(builder.sdiv(frame.pop(), frame.pop()))
+            elif op == DUMP:
+                self.print_stack_top(frame)
+            elif op == INCREMENT:
+                frame.push(builder.add(frame.pop(), ir.Constant(int32, 1)))
+            elif op == DECREMENT:
+                frame.push(builder.sub(frame.pop(), ir.Constant(int32, 1)))
+            elif op == DUP:
+                frame.push(frame.peek())
+            elif op == BREAK:
                 break
-            elif opcode[0] == RETURN:
-                builder.ret(pop_stack())
-                return
-            elif opcode[0] == IF:
-                condition_opcode = body[i + 1]
-                truth = self.evaluate_condition(condition_opcode, builder, pop_stack, copy_pop)
-                if body[i + 2][0] == DO:
-                    j = i + 3
-                    block, end_index = self.extract_block(body, j)
-                    with builder.if_then(truth):
-                        self.compile(block, builder, pop_stack, push_stack, copy_pop, push_bottom, pop_bottom)
-                    i = end_index
-            elif opcode[0] == WHILE:
-                condition_block = builder.append_basic_block(name="condition")
-                loop_block = builder.append_basic_block(name="loop")
-                end_block = builder.append_basic_block(name="end")
-                builder.branch(condition_block)
-                builder.position_at_end(condition_block)
-                condition_opcode = body[i + 1]
-                truth = self.evaluate_condition(condition_opcode, builder, pop_stack, copy_pop)
-                builder.cbranch(truth, loop_block, end_block)
-                builder.position_at_end(loop_block)
-                start_i = i
-                if body[i + 2][0] == DO:
-                    j = i + 3
-                    block, end_index = self.extract_block(body, j)
-                    self.compile(block, builder, pop_stack, push_stack, copy_pop, push_bottom, pop_bottom)
-                    builder.branch(condition_block)
-                    i = end_index
-                builder.position_at_end(end_block)
-            else:
-                raise Exception(f"Unknown opcode: {opcode}")
-            i += 1
-        builder.ret(ir.Constant(ir.IntType(32), 0))
-
-    def compile(self, program, builder=None, pop_stack=None, push_stack=None, copy_pop=None, push_bottom=None, pop_bottom=None):
-        if builder is None:
-            builder = self.builder
-        if pop_stack is None:
-            pop_stack = self.pop_stack
-        if push_stack is None:
-            push_stack = self.push_stack
-        if copy_pop is None:
-            copy_pop = self.copy_pop
-        if push_bottom is None:
-            push_bottom = self.push_bottom
-        if pop_bottom is None:
-            pop_bottom = self.pop_bottom
-
-        i = 0
-        while i < len(program):
-            opcode = program[i]
-            if opcode[0] == PUSH:
-                push_stack(ir.Constant(ir.IntType(32), opcode[1]))
-            elif opcode[0] == SWAP:
-                top = pop_stack()
-                second = pop_stack()
-                push_stack(top)
-                push_stack(second)
-            elif opcode[0] == ROT:
-                top = pop_stack()
-                second = pop_stack()
-                third = pop_stack()
-                push_stack(top)
-                push_stack(third)
-                push_stack(second)
-            elif opcode[0] == POP:
-                pop_stack()
-            elif opcode[0] == ADD:
-                push_stack(builder.add(pop_stack(), pop_stack()))
-            elif opcode[0] == FLIP:
-                top = pop_stack()
-                bottom = pop_bottom()
-                push_bottom(top)
-                push_stack(bottom)
-            elif opcode[0] == OVER:
-                push_stack(copy_pop(-2))
-            elif opcode[0] == SUB:
-                push_stack(builder.sub(pop_stack(), pop_stack()))
-            elif opcode[0] == MUL:
-                push_stack(builder.mul(pop_stack(), pop_stack()))
-            elif opcode[0] == DIV:
-                push_stack(builder.sdiv(pop_stack(), pop_stack()))
-            elif opcode[0] == DUMP:
-                self.print_stack_top()
-            elif opcode[0] == INCREMENT:
-                top = pop_stack()
-                push_stack(builder.add(top, ir.Constant(ir.IntType(32), 1)))
-            elif opcode[0] == DECREMENT:
-                top = pop_stack()
-                push_stack(builder.sub(top, ir.Constant(ir.IntType(32), 1)))
-            elif opcode[0] == DUP:
-                push_stack(copy_pop())
-            elif opcode[0] == BREAK:
+            elif op == RETURN:
+                if frame is self.frame:
+                    raise Exception("Return outside of function")
+                builder.ret(frame.pop())
                 break
-            elif opcode[0] == FUNCTION:
-                name = opcode[1]
-                argcount = opcode[2]
-                body, end_index = self.extract_block(program, i + 2)
-                self.compile_function(name, body, argcount)
-                i = end_index
-            elif opcode[0] == CALL:
-                func_name = opcode[1]
+            elif op == FUNCTION:
+                name, argcount = self.program[i][1:]
+                self.compile_function(name, i + 2, self.jumps[i], argcount)
+                i = self.jumps[i]
+            elif op == CALL:
+                func_name = self.program[i][1]
                 if func_name in self.functions:
-                    func = self.functions[func_name]
-                    argcount = len(func.args)
-                    args = [pop_stack() for _ in range(argcount)]
-                    args.reverse()
-                    retval = builder.call(func, args)
-                    push_stack(retval)
+                    func = self.callee(func_name)
+                    args = [frame.pop() for _ in range(len(func.args))]
+                    # Calls that are the last step of a function must not grow
+                    # the native stack, so deep recursion works. A function
+                    # calling itself that way starts over with the new
+                    # arguments; a call before the end hands its result on
+                    # like one before return.
+                    before_end = frame is not self.frame and self.tails.get(i, False)
+                    if before_end and func is builder.function and frame.restart is not None:
+                        for phi, argument in zip(frame.arguments, args):
+                            phi.add_incoming(argument, builder.block)
+                        builder.branch(frame.restart)
+                        break
+                    tail = False
+                    if before_end or frame is not self.frame and i + 1 < end and ops[i + 1] == RETURN:
+                        tail = "musttail" if func.function_type == builder.function.function_type else "tail"
+                    result = builder.call(func, args, tail=tail)
+                    if before_end:
+                        builder.ret(result)
+                        break
+                    frame.push(result)
                 else:
                     raise Exception(f"Function {func_name} not found")
-            elif opcode[0] == IF:
-                condition_opcode = program[i + 1]
-                truth = self.evaluate_condition(condition_opcode, builder, pop_stack, copy_pop)
-                if program[i + 2][0] == DO:
-                    j = i + 3
-                    block, end_index = self.extract_block(program, j)
-                    with builder.if_then(truth):
-                        self.compile(block, builder, pop_stack, push_stack, copy_pop, push_bottom, pop_bottom)
-                    i = end_index
-            elif opcode[0] == WHILE:
-                condition_block = builder.append_basic_block(name="condition")
-                loop_block = builder.append_basic_block(name="loop")
-                end_block = builder.append_basic_block(name="end")
-                builder.branch(condition_block)
-                builder.position_at_end(condition_block)
-                condition_opcode = program[i + 1]
-                truth = self.evaluate_condition(condition_opcode, builder, pop_stack, copy_pop)
-                builder.cbranch(truth, loop_block, end_block)
-                builder.position_at_end(loop_block)
-                start_i = i
-                if program[i + 2][0] == DO:
-                    j = i + 3
-                    block, end_index = self.extract_block(program, j)
-                    self.compile(block, builder, pop_stack, push_stack, copy_pop, push_bottom, pop_bottom)
-                    builder.branch(condition_block)
-                    i = end_index
-                builder.position_at_end(end_block)
+            elif op == IF:
+                self.compile_if(frame, i)
+                i = self.jumps[i]
+            elif op == WHILE:
+                self.compile_while(frame, i)
+                i = self.jumps[i]
             else:
-                raise Exception(f"Unknown opcode: {opcode}")
+                raise Exception(f"Unknown opcode: {self.program[i]}")
             i += 1
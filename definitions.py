@@ -1,9 +1,10 @@
+from array import array
+
 iota_count = 0
 def iota(reset=False):
     global iota_count
     if reset:
         iota_count = 0
-        return
     result = iota_count
     iota_count += 1
     return result
@@ -39,6 +40,9 @@ ROT = iota()
 OVER = iota()
 FLIP = iota()
 ELSE = iota()
+PUSH_CONST = iota()
+ADD_IMM = iota()
+PROBE = iota()
 COUNT_OPCODES = 18
 
 # Opcode functions
@@ -64,6 +68,12 @@ def push(x):
 def pop():
    return (POP,)
 
+def add_imm(x):
+   return (ADD_IMM, x)
+
+def probe(n):
+   return (PROBE, n)
+
 def if_statement():
    return (IF,)
 
@@ -133,82 +143,101 @@ def decrement():
 def increment():
    return (INCREMENT,)
 
-def tokenize_file(file_name):
+# Tokens that stand for an opcode on their own
+TOKENS = {
+   "drop": pop,
+   "+": add,
+   "-": sub,
+   "*": mul,
+   "/": div,
+   "else": else_statement,
+   ".": dump,
+   "dup": dup,
+   "rot": rot,
+   "if": if_statement,
+   "begin": begin,
+   "break": break_loop,
+   "do": do,
+   "swap": swap,
+   "over": over,
+   "end": end,
+   "flip": flip,
+   "while": while_statement,
+   "return": returns,
+   "==": is_eql,
+   "!=": is_neq,
+   ">": is_grt,
+   "<": is_lss,
+   ">=": is_geq,
+   "<=": is_leq,
+   "--": decrement,
+   "++": increment,
+}
+
+def read_tokens(file_name):
+   # Yields (token, line, column), reading the file a line at a time
    with open(file_name, 'r') as f:
-      content = f.read()
-      tokens = [x for x in content.split() if x]
-
-   program = []
-   i = 0
-   while i < len(tokens):
-      token = tokens[i]
-      if token == "drop":
-         program.append(pop())
-      elif token == "+":
-         program.append(add())
-      elif token == "-":
-         program.append(sub())
-      elif token == "*":
-         program.append(mul())
-      elif token == "else":
-         program.append(else_statement())
-      elif token == "/":
-         program.append(div())
-      elif token == ".":
-         program.append(dump())
-      elif token == "dup":
-         program.append(dup())
-      elif token == "rot":
-         program.append(rot())
-      elif token == "if":
-         program.append(if_statement())
-      elif token == "begin":
-         program.append(begin())
-      elif token == "break":
-         program.append(break_loop())
+      for line, text in enumerate(f, 1):
+         column = 0
+         for token in text.split():
+            column = text.index(token, column)
+            yield token, line, column + 1
+            column += len(token)
+
+def tokenize(file_name):
+   # Yields (opcode, line, column) for each instruction in the file
+   tokens = read_tokens(file_name)
+
+   def operand(token, line, column):
+      try:
+         return next(tokens)[0]
+      except StopIteration:
+         raise Exception("{}:{}:{}: Missing operand for {}".format(file_name, line, column, token))
+
+   for token, line, column in tokens:
+      if token in TOKENS:
+         yield TOKENS[token](), line, column
       elif token == "call":
-         program.append(call(tokens[i + 1]))
-         i += 1
-      elif token == "do":
-         program.append(do())
-      elif token == "swap":
-         program.append(swap())
-      elif token == "over":
-         program.append(over())
-      elif token == "end":
-         program.append(end())
-      elif token == ".":
-         program.append(dump())
-      elif token == "flip":
-         program.append(flip())
-      elif token == "while":
-         program.append(while_statement())
+         yield call(operand(token, line, column)), line, column
       elif token == "function":
-         program.append(function(tokens[i + 1], int(tokens[i + 2])))
-         i += 2
-      elif token == "return":
-         program.append(returns())
-      elif token == "==":
-         program.append(is_eql())
-      elif token == "!=":
-         program.append(is_neq())
-      elif token == ">":
-         program.append(is_grt())
-      elif token == "<":
-         program.append(is_lss())
-      elif token == ">=":
-         program.append(is_geq())
-      elif token == "<=":
-         program.append(is_leq())
-      elif token == "--":
-         program.append(decrement())
-      elif token == "++":
-         program.append(increment())
+         name = operand(token, line, column)
+         argcount = operand(token, line, column)
+         try:
+            argcount = int(argcount)
+         except ValueError:
+            raise Exception("{}:{}:{}: Bad argument count: {}".format(file_name, line, column, argcount))
+         yield function(name, argcount), line, column
       else:
          try:
-            program.append(push(int(token)))
-         except:
-            raise Exception("Unknown token: {}".format(token))
-      i += 1
+            value = int(token)
+         except ValueError:
+            raise Exception("{}:{}:{}: Unknown token: {}".format(file_name, line, column, token))
+         yield push(value), line, column
 
-   return program
+def tokenize_file(file_name):
+   return [opcode for opcode, line, column in tokenize(file_name)]
+
+def link(ops):
+   jumps = array('l', [0]) * len(ops)
+   blocks = []
+   for i, op in enumerate(ops):
+      if op in (IF, WHILE, FUNCTION):
+         blocks.append((i, []))
+      elif op == BREAK:
+         if blocks:
+            blocks[-1][1].append(i)
+         else:
+            jumps[i] = len(ops)
+      elif op == END:
+         if not blocks:
+            raise Exception("Unmatched end at instruction {}".format(i))
+         start, breaks = blocks.pop()
+         jumps[start] = i
+         jumps[i] = start
+         for j in breaks:
+            jumps[j] = i
+
+   if blocks:
+      raise Exception("Unterminated block at instruction {}".format(blocks[-1][0]))
+
+   return jumps
@@ -0,0 +1,27 @@
+# Generated by superinstructions.py from 4 file(s); do not edit.
+# Each entry is an opcode sequence the interpreter executes as one step.
+FUSIONS = [
+    ('WHILE', 'IS_GRT', 'DO', 'SWAP', 'ADD_IMM', 'SWAP'),  # 110
+    ('WHILE', 'IS_GRT', 'DO', 'SWAP'),  # 130
+    ('WHILE', 'IS_GRT', 'DO'),  # 140
+    ('SWAP', 'ADD_IMM', 'SWAP'),  # 120
+    ('ADD_IMM', 'SWAP'),  # 140
+    ('WHILE', 'IS_GRT', 'DO', 'SWAP', 'ADD_IMM', 'SWAP', 'OVER', 'ROT'),  # 10
+    ('WHILE', 'IS_GRT', 'DO', 'SWAP', 'DUMP', 'ADD_IMM', 'SWAP'),  # 10
+    ('WHILE', 'IS_GRT', 'DO', 'SWAP', 'PUSH', 'PUSH'),  # 10
+    ('ROT', 'ROT', 'ROT', 'SWAP', 'ADD_IMM', 'SWAP'),  # 10
+    ('POP', 'POP', 'ADD_IMM', 'SWAP'),  # 10
+    ('SWAP', 'PUSH', 'PUSH'),  # 11
+    ('ROT', 'ROT'),  # 20
+    ('PUSH', 'PUSH'),  # 14
+    ('DUMP', 'POP', 'DUMP'),  # 3
+    ('DUMP', 'POP'),  # 5
+    ('POP', 'PUSH', 'SWAP', 'PUSH', 'PUSH'),  # 1
+    ('DUMP', 'POP', 'DUMP', 'POP', 'DUMP'),  # 1
+    ('IF', 'IS_LSS', 'DO', 'POP', 'DECREMENT'),  # 1
+    ('IF', 'IS_GRT', 'DO', 'POP'),  # 1
+    ('POP', 'PUSH'),  # 2
+    ('POP', 'DUP', 'DECREMENT'),  # 1
+    ('DUMP', 'POP', 'PUSH'),  # 1
+    ('SWAP', 'DECREMENT', 'DECREMENT'),  # 1
+]
@@ -1,153 +1,241 @@
+from itertools import count
 from definitions import *
+from bytecode import assemble, tail_calls
+from analyzer import StackAnalysis
+from superinstructions import SUPER, load_handlers, fuse
+import output
 
-stack_suspened = []
 stack = []
 call_stack = []
 functions = {}
+handlers = load_handlers()
 
-def simulate(program, using_functions=False):
+class VM:
+    # One running program. All of its state lives in the instance, so any
+    # number of programs can be in progress at once, and run() can stop
+    # after a number of steps and later carry on where it stopped.
+    def __init__(self, program, stack=None, call_stack=None, functions=None, out=None, profiler=None):
+        self.program = assemble(program)
 
-    global stack
-    global stack_suspened
-    global functions
-    
-    def pop_stack():
-        return stack.pop()
+        # jumps[i] holds the matching end of an if/while/function, the
+        # opening instruction of an end, and the enclosing end of a break
+        self.jumps = link(self.program.ops)
+        self.tails = tail_calls(self.program, self.jumps)
 
-    def pop_bottom():
-        return stack.pop(0)
+        # The checks that a frame holds enough values are only needed when
+        # the analysis cannot rule out that it does not
+        self.checked = not StackAnalysis(self.program).safe()
 
-    def push_bottom(x):
-        stack.insert(0, x)
+        # Dispatch runs on a copy of ops where common sequences start with
+        # SUPER and are executed in one step by their handler in fused
+        self.ops, self.fused = fuse(self.program.ops, handlers)
 
-    def copy_pop(offset=-1):
-        return stack[offset]
+        # Every call frame is the window stack[base:] of one shared value
+        # stack; call_stack holds the caller's return index and base, and
+        # whether the caller drops the returned value because the call was
+        # its last step
+        self.stack = [] if stack is None else stack
+        self.call_stack = [] if call_stack is None else call_stack
+        self.functions = {} if functions is None else functions
+        self.output = output.stdout if out is None else out
+        # The profiler.Profiler counting the probes of an instrumented program
+        self.profiler = profiler
+        self.i = 0
+        self.base = 0
+        # Steps run so far, where a fused sequence is a single step
+        self.steps = 0
 
-    def push_stack(x):
-        stack.append(x)
+    def finished(self):
+        return self.i >= len(self.ops)
 
-    def evaluate_condition(condition_opcode):
-        if condition_opcode[0] == IS_EQL:
-            return copy_pop() == copy_pop(-2)
-        elif condition_opcode[0] == IS_NEQ:
-            return copy_pop() != copy_pop(-2)
-        elif condition_opcode[0] == IS_GRT:
-            return copy_pop() > copy_pop(-2)
-        elif condition_opcode[0] == IS_LSS:
-            return copy_pop() < copy_pop(-2)
-        elif condition_opcode[0] == IS_GEQ:
-            return copy_pop() >= copy_pop(-2)
-        elif condition_opcode[0] == IS_LEQ:
-            return copy_pop() <= copy_pop(-2)
-        else:
-            raise Exception("Unknown condition opcode: {}".format(condition_opcode))
+    def run(self, budget=None):
+        # Runs the program until it ends, or for at most budget steps.
+        # Returns True once it has ended.
+        program = self.program
+        ops = self.ops
+        args = program.args
+        consts = program.consts
+        jumps = self.jumps
+        tails = self.tails
+        checked = self.checked
+        fused = self.fused
+        stack = self.stack
+        call_stack = self.call_stack
+        functions = self.functions
+        out = self.output
+        profiler = self.profiler
+        end = len(ops)
+        i = self.i
+        base = self.base
 
-    def extract_block(program, start_index):
-        block = []
-        depth = 0
-        i = start_index
-        while i < len(program):
-            opcode = program[i]
-            if opcode[0] in [IF, WHILE, FUNCTION]:
-                depth += 1
-            elif opcode[0] == END:
-                if depth == 0:
-                    break
-                depth -= 1
-            block.append(opcode)
-            i += 1
-        return block, i
+        def evaluate_condition(condition):
+            if condition == IS_EQL:
+                return stack[-1] == stack[-2]
+            elif condition == IS_NEQ:
+                return stack[-1] != stack[-2]
+            elif condition == IS_GRT:
+                return stack[-1] > stack[-2]
+            elif condition == IS_LSS:
+                return stack[-1] < stack[-2]
+            elif condition == IS_GEQ:
+                return stack[-1] >= stack[-2]
+            elif condition == IS_LEQ:
+                return stack[-1] <= stack[-2]
+            else:
+                raise Exception("Unknown condition opcode: {}".format(program[i + 1]))
 
-    i = 0
-    while i < len(program):
-        opcode = program[i]
-        if opcode[0] == PUSH:
-            push_stack(opcode[1])
-        elif opcode[0] == POP:
-            pop_stack()
-        elif opcode[0] == ADD:
-            push_stack(pop_stack() + pop_stack())
-        elif opcode[0] == SUB:
-            push_stack(pop_stack() - pop_stack())
-        elif opcode[0] == SWAP:
-            top = pop_stack()
-            second = pop_stack()
-            push_stack(top)
-            push_stack(second)
-        elif opcode[0] == ROT:
-            top = pop_stack() # top becomes third
-            second = pop_stack() # second becomes first
-            third = pop_stack() # third becomes second
-            push_stack(top)
-            push_stack(third)
-            push_stack(second)
-        elif opcode[0] == OVER:
-            push_stack(copy_pop(-2))
-        elif opcode[0] == MUL:
-            push_stack(pop_stack() * pop_stack())
-        elif opcode[0] == DIV:
-            push_stack(pop_stack() / pop_stack())
-        elif opcode[0] == DECREMENT:
-            top = pop_stack()
-            push_stack(top - 1)
-        elif opcode[0] == FLIP:
-            top = pop_stack()
-            bottom = pop_bottom()
+        # Values printed by DUMP are collected in pending and written out in
+        # batches
+        pending = out.pending
+        flush = out.flush
+        batch_size = output.BATCH_SIZE
 
-            push_bottom(top)
-            push_stack(bottom)
-        elif opcode[0] == INCREMENT:
-            top = pop_stack()
-            push_stack(top + 1)
-        elif opcode[0] == DUMP:
-            print(stack[-1])
-        elif opcode[0] == DUP:
-            push_stack(copy_pop())
-        elif opcode[0] == BREAK:
-            break
-        elif opcode[0] == FUNCTION:
-            name = opcode[1]
-            argcount = opcode[2]
-            block, end_index = extract_block(program, i + 2)
-            functions[name] = {
-                "name": name,
-                "number_of_args": argcount,
-                "body": block
-            }
-            i = end_index
-        elif opcode[0] == RETURN:
-            if using_functions:
-                stack_suspened.append(stack.pop())
-                stack = stack_suspened
-                return
-            else:
-                raise Exception("Return outside of function")
-        elif opcode[0] == CALL:
-            if opcode[1] in functions:
-                stack_suspened = stack
-                stack = []
-                number_of_args = functions[opcode[1]]["number_of_args"]
-                for _ in range(number_of_args):
-                    stack.append(stack_suspened.pop())
-                simulate(functions[opcode[1]]["body"], using_functions=True)
-                stack = stack_suspened
-                stack_suspened = []
+        taken = 0
+        done = True
+        try:
+            for taken in count() if budget is None else range(budget):
+                if i >= end:
+                    break
+                op = ops[i]
+                if op == SUPER:
+                    i = fused[i](stack, args, jumps, i, out)
+                    continue
+                elif op == PUSH:
+                    stack.append(args[i])
+                elif op == PUSH_CONST:
+                    stack.append(consts[args[i]])
+                elif op == POP:
+                    stack.pop()
+                elif op == ADD_IMM:
+                    stack[-1] += args[i]
+                elif op == ADD:
+                    stack.append(stack.pop() + stack.pop())
+                elif op == SUB:
+                    stack.append(stack.pop() - stack.pop())
+                elif op == SWAP:
+                    top = stack.pop()
+                    second = stack.pop()
+                    stack.append(top)
+                    stack.append(second)
+                elif op == ROT:
+                    top = stack.pop() # top becomes third
+                    second = stack.pop() # second becomes first
+                    third = stack.pop() # third becomes second
+                    stack.append(top)
+                    stack.append(third)
+                    stack.append(second)
+                elif op == OVER:
+                    stack.append(stack[-2])
+                elif op == MUL:
+                    stack.append(stack.pop() * stack.pop())
+                elif op == DIV:
+                    stack.append(stack.pop() / stack.pop())
+                elif op == DECREMENT:
+                    stack.append(stack.pop() - 1)
+                elif op == FLIP:
+                    # Exchanging the two ends in place keeps flip O(1) at any depth
+                    if checked and len(stack) - base < 2:
+                        raise Exception("Not enough values on the stack to flip")
+                    stack[base], stack[-1] = stack[-1], stack[base]
+                elif op == INCREMENT:
+                    stack.append(stack.pop() + 1)
+                elif op == DUMP:
+                    pending.append(stack[-1])
+                    if len(pending) >= batch_size:
+                        flush()
+                elif op == DUP:
+                    stack.append(stack[-1])
+                elif op == WHILE or op == IF:
+                    if evaluate_condition(ops[i + 1]):
+                        i += 3
+                        continue
+                    i = jumps[i]
+                elif op == END:
+                    start = jumps[i]
+                    if program.ops[start] == WHILE:
+                        i = start
+                        continue
+                    elif program.ops[start] == FUNCTION:
+                        if checked and len(stack) < base:
+                            raise Exception("Stack underflow in function")
+                        del stack[base:]
+                        i, base, _ = call_stack.pop()
+                        continue
+                elif op == BREAK:
+                    # break leaves the innermost block, so it lands on that block's end
+                    i = jumps[i]
+                    continue
+                elif op == FUNCTION:
+                    name, argcount = consts[args[i]]
+                    functions[name] = {
+                        "name": name,
+                        "number_of_args": argcount,
+                        "body": i + 2
+                    }
+                    i = jumps[i]
+                elif op == RETURN:
+                    if not call_stack:
+                        raise Exception("Return outside of function")
+                    if checked and len(stack) <= base:
+                        raise Exception("Stack underflow in function")
+                    value = stack.pop()
+                    del stack[base:]
+                    i, base, drops = call_stack.pop()
+                    if not drops:
+                        stack.append(value)
+                    continue
+                elif op == CALL:
+                    name = consts[args[i]]
+                    if name in functions:
+                        function = functions[name]
+                        argcount = function["number_of_args"]
+                        if checked and len(stack) - base < argcount:
+                            raise Exception("Not enough arguments for function {}".format(name))
+                        if i in tails and call_stack:
+                            # A call in tail position replaces the caller's frame
+                            # with the callee's, so recursion like this runs in
+                            # constant space
+                            arguments = stack[len(stack) - argcount:]
+                            del stack[base:]
+                            stack.extend(reversed(arguments))
+                            if tails[i]:
+                                index, caller_base, _ = call_stack[-1]
+                                call_stack[-1] = (index, caller_base, True)
+                            i = function["body"]
+                            continue
+                        call_stack.append((i + 1, base, False))
+                        base = len(stack) - argcount
+
+                        # The arguments stay where they are and become the bottom of
+                        # the new frame, reversed so the caller's top is at the bottom
+                        low = base
+                        high = len(stack) - 1
+                        while low < high:
+                            stack[low], stack[high] = stack[high], stack[low]
+                            low += 1
+                            high -= 1
+                        i = function["body"]
+                        continue
+                    else:
+                        raise Exception("Function {} not found".format(name))
+                elif op == PROBE:
+                    profiler.hit(args[i])
+                else:
+                    raise Exception("Unknown opcode: {}".format(program[i]))
+                i += 1
             else:
-                raise Exception("Function {} not found".format(opcode[1]))
-        elif opcode[0] == IF:
-            condition_opcode = program[i + 1]
-            truth = evaluate_condition(condition_opcode)
-            block, end_index = extract_block(program, i + 3)
-            if truth:
-                simulate(block)
-            i = end_index
-        elif opcode[0] == WHILE:
-            start_i = i
-            condition_opcode = program[i + 1]
-            block, end_index = extract_block(program, i + 3)
-            while evaluate_condition(condition_opcode):
-                simulate(block)
-            i = end_index
-        else:
-            raise Exception("Unknown opcode: {}".format(opcode))
-        i += 1
+                # Out of budget, unless the last step ended the program
+                taken = budget
+                done = i >= end
+        finally:
+            self.steps += taken
+            self.i = i
+            self.base = base
+            if done:
+                flush()
+        return done
+
+def simulate(program, profiler=None):
+    # Runs a program to the end on the module's stack, call stack and
+    # functions, so callers can set them up and inspect them afterwards
+    VM(program, stack, call_stack, functions, profiler=profiler).run()
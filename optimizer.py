@@ -0,0 +1,127 @@
+from definitions import *
+from bytecode import Bytecode, assemble
+
+# Folded constants must survive the compiled backend's 32-bit arithmetic
+MIN_FOLD = -(1 << 31)
+MAX_FOLD = (1 << 31) - 1
+
+FOLDS = {
+    ADD: lambda top, second: top + second,
+    SUB: lambda top, second: top - second,
+    MUL: lambda top, second: top * second,
+}
+
+# Adjacent pairs that leave the stack exactly as it was
+CANCELLING = {
+    (SWAP, SWAP): "swap swap",
+    (DUP, POP): "dup drop",
+    (INCREMENT, DECREMENT): "++ --",
+    (DECREMENT, INCREMENT): "-- ++",
+}
+
+def count(report, name, removed):
+    report[name] = report.get(name, 0) + 1
+    report["removed"] += removed
+
+def remove_dead_code(code, report):
+    # Drops everything between a break or return and the end of the block
+    # it leaves, keeping that end
+    result = []
+    skipping = False
+    depth = 0
+    for entry in code:
+        op = entry[0][0]
+        if skipping:
+            if op in (IF, WHILE, FUNCTION):
+                depth += 1
+            elif op == END:
+                if depth == 0:
+                    skipping = False
+                else:
+                    depth -= 1
+            if skipping:
+                report["dead code"] = report.get("dead code", 0) + 1
+                report["removed"] += 1
+                continue
+        result.append(entry)
+        if op == BREAK or op == RETURN:
+            skipping = True
+            depth = 0
+    return result
+
+def is_push(entry):
+    return entry[0][0] == PUSH and isinstance(entry[0][1], int)
+
+def fits(value):
+    return MIN_FOLD <= value <= MAX_FOLD
+
+def reduce_tail(code, report):
+    # Rewrites the last few instructions if they match a pattern; returns
+    # True when something changed so the caller can try again
+    if len(code) >= 3 and is_push(code[-3]) and is_push(code[-2]) and code[-1][0][0] in FOLDS:
+        value = FOLDS[code[-1][0][0]](code[-2][0][1], code[-3][0][1])
+        if fits(value):
+            code[-3:] = [(push(value),) + code[-3][1:]]
+            count(report, "constant fold", 2)
+            return True
+
+    if len(code) < 2:
+        return False
+    first, second = code[-2], code[-1]
+    pair = (first[0][0], second[0][0])
+
+    if pair in CANCELLING:
+        del code[-2:]
+        count(report, CANCELLING[pair], 2)
+        return True
+    if is_push(first) and pair[1] == POP:
+        del code[-2:]
+        count(report, "push drop", 2)
+        return True
+    if is_push(first) and pair[1] in (ADD_IMM, INCREMENT, DECREMENT):
+        step = second[0][1] if pair[1] == ADD_IMM else (1 if pair[1] == INCREMENT else -1)
+        if fits(first[0][1] + step):
+            code[-2:] = [(push(first[0][1] + step),) + first[1:]]
+            count(report, "constant fold", 1)
+            return True
+    if is_push(first) and pair[1] == ADD and fits(first[0][1]):
+        code[-2:] = [(add_imm(first[0][1]),) + first[1:]]
+        count(report, "add immediate", 1)
+        return True
+    if pair == (ADD_IMM, ADD_IMM) and fits(first[0][1] + second[0][1]):
+        code[-2:] = [(add_imm(first[0][1] + second[0][1]),) + first[1:]]
+        count(report, "add immediate", 1)
+        return True
+    if pair[1] == ADD_IMM and second[0][1] == 0:
+        del code[-1]
+        count(report, "add immediate", 1)
+        return True
+    return False
+
+def optimize(program):
+    # Returns the optimized program as Bytecode along with a report of what
+    # each rewrite removed
+    program = assemble(program)
+    code = [(program[i], program.lines[i], program.columns[i]) for i in range(len(program))]
+    report = {"before": len(code), "removed": 0}
+
+    code = remove_dead_code(code, report)
+
+    result = []
+    for entry in code:
+        result.append(entry)
+        while reduce_tail(result, report):
+            pass
+
+    bytecode = Bytecode()
+    for opcode, line, column in result:
+        bytecode.append(opcode, line, column)
+    report["after"] = len(bytecode)
+    return bytecode, report
+
+def format_report(report):
+    lines = ["peephole: {} -> {} instructions".format(report["before"], report["after"])]
+    for name in sorted(report):
+        if name not in ("before", "after", "removed"):
+            lines.append("  {:<16} {}".format(name, report[name]))
+    return "\n".join(lines)
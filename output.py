@@ -0,0 +1,40 @@
+import sys
+
+# Values printed by dump are collected and written out this many at a time
+BATCH_SIZE = 4096
+
+class Output:
+    # Where a program's DUMPs go: stdout, or the write function given,
+    # which receives the text of every batch
+    def __init__(self, write=None):
+        self.pending = []
+        self.write = write
+
+    def dump(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = "\n".join(map(str, self.pending)) + "\n"
+        self.pending.clear()
+        if self.write is not None:
+            self.write(text)
+            return
+        # Anything printed through sys.stdout has to come out first
+        sys.stdout.flush()
+        buffer = getattr(sys.stdout, "buffer", None)
+        if buffer is None:
+            sys.stdout.write(text)
+        else:
+            buffer.write(text.encode())
+            buffer.flush()
+
+stdout = Output()
+
+# The module-level functions print to stdout
+pending = stdout.pending
+dump = stdout.dump
+flush = stdout.flush
@@ -0,0 +1,185 @@
+import json
+import time
+import interpreter
+from definitions import *
+from bytecode import Bytecode, assemble
+from superinstructions import opcode_names
+
+HOT_SPOTS = 20
+
+class Profiler:
+    def __init__(self, program, file_name=""):
+        # Profiling runs a copy of the program with a PROBE at the start of
+        # every basic block and around every call, so the interpreter itself
+        # does no bookkeeping. Instructions inside a block run as often as
+        # the block is entered, which gives the per-instruction counts.
+        self.program = assemble(program)
+        self.file_name = file_name
+        self.probes = []
+        self.hits = []
+        # (start, time spent in callees) of every call in progress
+        self.timers = []
+        self.functions = {}
+        # Calls in progress per function, so recursion counts towards the
+        # total only once
+        self.active = {}
+        self.elapsed = 0.0
+        self.instrumented = self.instrument()
+
+    def add_probe(self, code, kind, i):
+        # A probe past the last instruction has no position of its own
+        position = self.program.position(i) if i < len(self.program) else (0, 0)
+        code.append(probe(len(self.probes)), *position)
+        self.probes.append((kind, i))
+        self.hits.append(0)
+
+    def instrument(self):
+        program = self.program
+        ops = program.ops
+        jumps = link(ops)
+
+        leaders = {0}
+        for i, op in enumerate(ops):
+            if op == IF or op == WHILE:
+                leaders.add(i + 3)
+                leaders.add(jumps[i] + 1)
+            elif op == FUNCTION:
+                leaders.add(i + 2)
+                leaders.add(jumps[i] + 1)
+            elif op == END or op == CALL:
+                leaders.add(i + 1)
+
+        code = Bytecode()
+        for i in range(len(ops) + 1):
+            # Every return lands right after its call
+            if i > 0 and ops[i - 1] == CALL:
+                self.add_probe(code, "return", i - 1)
+            if i in leaders:
+                self.add_probe(code, "block", i)
+            if i == len(ops):
+                break
+            if ops[i] == CALL:
+                self.add_probe(code, "call", i)
+            code.append(program[i], *program.position(i))
+        return code
+
+    def hit(self, n):
+        self.hits[n] += 1
+        kind, i = self.probes[n]
+        if kind == "call":
+            name = self.program.consts[self.program.args[i]]
+            self.active[name] = self.active.get(name, 0) + 1
+            self.timers.append([time.perf_counter(), 0.0])
+        elif kind == "return":
+            start, inner = self.timers.pop()
+            spent = time.perf_counter() - start
+            if self.timers:
+                self.timers[-1][1] += spent
+            name = self.program.consts[self.program.args[i]]
+            self.active[name] -= 1
+            entry = self.functions.setdefault(name, {"calls": 0, "total": 0.0, "self": 0.0})
+            entry["calls"] += 1
+            entry["self"] += spent - inner
+            if self.active[name] == 0:
+                entry["total"] += spent
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            interpreter.simulate(self.instrumented, self)
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+    def block_hits(self):
+        return {i: self.hits[n] for n, (kind, i) in enumerate(self.probes) if kind == "block"}
+
+    def counts(self):
+        # Execution count of every instruction of the original program
+        ops = self.program.ops
+        jumps = link(ops)
+        blocks = self.block_hits()
+        counts = [0] * len(ops)
+        # Runs of every end from the breaks that jump to it, past its probe
+        breaks = {}
+        for i, op in enumerate(ops):
+            if i in blocks:
+                counts[i] = blocks[i]
+            elif op == DO or i == 0 or ops[i - 1] in (BREAK, RETURN, FUNCTION):
+                # Skipped by dispatch or unreachable
+                counts[i] = 0
+            else:
+                counts[i] = counts[i - 1]
+            if op == WHILE:
+                # The header runs again after every iteration
+                counts[i] += blocks.get(i + 3, 0)
+            elif op == BREAK:
+                breaks[jumps[i]] = breaks.get(jumps[i], 0) + counts[i]
+            elif op == END:
+                counts[i] += breaks.get(i, 0)
+        return counts
+
+    def location(self, i):
+        line, column = self.program.position(i)
+        return "{}:{}:{}".format(self.file_name, line, column)
+
+    def results(self):
+        names = opcode_names()
+        ops = self.program.ops
+        counts = self.counts()
+        blocks = self.block_hits()
+
+        opcodes = {}
+        spots = {}
+        for i, count in enumerate(counts):
+            if count == 0:
+                continue
+            name = names[ops[i]]
+            opcodes[name] = opcodes.get(name, 0) + count
+            key = self.program.position(i)
+            if key not in spots:
+                spots[key] = {"location": self.location(i), "opcode": name, "count": 0}
+            spots[key]["count"] += count
+
+        loops = [{"location": self.location(i), "iterations": blocks.get(i + 3, 0)}
+                 for i, op in enumerate(ops) if op == WHILE]
+        functions = [dict(name=name, **entry) for name, entry in self.functions.items()]
+
+        return {
+            "file": self.file_name,
+            "seconds": self.elapsed,
+            "instructions": sum(counts),
+            "opcodes": dict(sorted(opcodes.items(), key=lambda item: -item[1])),
+            "hot_spots": sorted(spots.values(), key=lambda spot: -spot["count"]),
+            "functions": sorted(functions, key=lambda entry: -entry["total"]),
+            "loops": sorted(loops, key=lambda loop: -loop["iterations"]),
+        }
+
+    def report(self):
+        results = self.results()
+        total = max(results["instructions"], 1)
+        lines = ["profile: {} instructions in {:.3f}s".format(results["instructions"], results["seconds"])]
+
+        lines.append("opcodes:")
+        for name, count in results["opcodes"].items():
+            lines.append("  {:<12} {:>12} {:>6.1f}%".format(name, count, 100.0 * count / total))
+
+        lines.append("hot spots:")
+        for spot in results["hot_spots"][:HOT_SPOTS]:
+            lines.append("  {:<24} {:<12} {:>12}".format(spot["location"], spot["opcode"], spot["count"]))
+
+        if results["functions"]:
+            lines.append("functions:")
+            lines.append("  {:<16} {:>10} {:>10} {:>10}".format("name", "calls", "total s", "self s"))
+            for entry in results["functions"]:
+                lines.append("  {:<16} {:>10} {:>10.4f} {:>10.4f}".format(
+                    entry["name"], entry["calls"], entry["total"], entry["self"]))
+
+        if results["loops"]:
+            lines.append("loops:")
+            for loop in results["loops"]:
+                lines.append("  {:<24} {:>12}".format(loop["location"], loop["iterations"]))
+        return "\n".join(lines)
+
+    def write_json(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.results(), f, indent=2)
@@ -0,0 +1,146 @@
+from definitions import *
+from bytecode import assemble, tail_calls
+import output
+
+CONDITIONS = {
+    IS_EQL: "==",
+    IS_NEQ: "!=",
+    IS_GRT: ">",
+    IS_LSS: "<",
+    IS_GEQ: ">=",
+    IS_LEQ: "<=",
+}
+
+# Straight-line opcodes, written against the local stack aliases push/pop
+STATEMENTS = {
+    POP: ["pop()"],
+    ADD: ["push(pop() + pop())"],
+    SUB: ["push(pop() - pop())"],
+    MUL: ["push(pop() * pop())"],
+    DIV: ["push(pop() / pop())"],
+    SWAP: ["top = pop()", "second = pop()", "push(top)", "push(second)"],
+    ROT: ["top = pop()", "second = pop()", "third = pop()", "push(top)", "push(third)", "push(second)"],
+    OVER: ["push(stack[-2])"],
+    FLIP: ["if len(stack) < 2:", "    raise Exception(\"Not enough values on the stack to flip\")", "stack[0], stack[-1] = stack[-1], stack[0]"],
+    DECREMENT: ["push(pop() - 1)"],
+    INCREMENT: ["push(pop() + 1)"],
+    DUMP: ["dump(stack[-1])"],
+    DUP: ["push(stack[-1])"],
+}
+
+class PyCodegen:
+    def __init__(self, program):
+        self.program = assemble(program)
+        self.jumps = link(self.program.ops)
+        self.tails = tail_calls(self.program, self.jumps)
+        self.lines = []
+        self.function_count = 0
+
+        self.emit(0, "def main():")
+        self.emit_frame(1, "stack = []")
+        self.compile(0, len(self.program), 1, in_function=False)
+        self.source = "\n".join(self.lines) + "\n"
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def emit_frame(self, indent, stack_init):
+        self.emit(indent, stack_init)
+        self.emit(indent, "push = stack.append")
+        self.emit(indent, "pop = stack.pop")
+
+    def condition(self, i):
+        op = self.program.ops[i + 1]
+        if op not in CONDITIONS:
+            raise Exception("Unknown condition opcode: {}".format(self.program[i + 1]))
+        return "stack[-1] {} stack[-2]".format(CONDITIONS[op])
+
+    def compile(self, start, end, indent, in_function, restart=None, in_while=False):
+        # restart is (name, Python name, argcount) of a function whose calls
+        # to itself as its last step start its loop over, which they can do
+        # from anywhere but inside a while loop of its own
+        ops = self.program.ops
+        emitted = len(self.lines)
+        i = start
+        while i < end:
+            op = ops[i]
+            if op in STATEMENTS:
+                for line in STATEMENTS[op]:
+                    self.emit(indent, line)
+            elif op == PUSH or op == PUSH_CONST:
+                self.emit(indent, "push({!r})".format(self.program[i][1]))
+            elif op == ADD_IMM:
+                self.emit(indent, "stack[-1] += {!r}".format(self.program[i][1]))
+            elif op == WHILE or op == IF:
+                keyword = "while" if op == WHILE else "if"
+                self.emit(indent, "{} {}:".format(keyword, self.condition(i)))
+                self.compile(i + 3, self.jumps[i], indent + 1, in_function, restart, in_while or op == WHILE)
+                i = self.jumps[i]
+            elif op == BREAK:
+                # Whatever follows a break in the same block never runs
+                if self.breaks_out_of_frame(i):
+                    self.emit(indent, "return")
+                break
+            elif op == RETURN:
+                if restart is not None:
+                    self.emit(indent, "return None if dropped else pop()")
+                elif in_function:
+                    self.emit(indent, "return pop()")
+                else:
+                    self.emit(indent, "raise Exception(\"Return outside of function\")")
+                break
+            elif op == FUNCTION:
+                name, argcount = self.program[i][1:]
+                python_name = "function_{}".format(self.function_count)
+                self.function_count += 1
+                self.emit(indent, "def {}(caller):".format(python_name))
+                if any(self.tails.get(j) is not None and self.program[j][1] == name for j in range(i + 2, self.jumps[i])):
+                    # Calls to itself as its last step run as a loop, so deep
+                    # recursion does not exhaust Python's stack. Once a call
+                    # before the end has dropped the result, so is the value
+                    # of any later return, as in simulate.
+                    self.emit(indent + 1, "stack = [caller.pop() for _ in range({})]".format(argcount))
+                    self.emit(indent + 1, "dropped = False")
+                    self.emit(indent + 1, "while True:")
+                    self.emit(indent + 2, "push = stack.append")
+                    self.emit(indent + 2, "pop = stack.pop")
+                    self.compile(i + 2, self.jumps[i], indent + 2, True, (name, python_name, argcount))
+                    self.emit(indent + 2, "return")
+                else:
+                    self.emit_frame(indent + 1, "stack = [caller.pop() for _ in range({})]".format(argcount))
+                    self.compile(i + 2, self.jumps[i], indent + 1, in_function=True)
+                self.emit(indent, "functions[{!r}] = {}".format(name, python_name))
+                i = self.jumps[i]
+            elif op == CALL:
+                name = self.program[i][1]
+                self.emit(indent, "function = functions.get({!r})".format(name))
+                self.emit(indent, "if function is None:")
+                self.emit(indent + 1, "raise Exception({!r})".format("Function {} not found".format(name)))
+                if restart is not None and not in_while and restart[0] == name and i in self.tails:
+                    self.emit(indent, "if function is {}:".format(restart[1]))
+                    self.emit(indent + 1, "stack = [pop() for _ in range({})]".format(restart[2]))
+                    if self.tails[i]:
+                        self.emit(indent + 1, "dropped = True")
+                    self.emit(indent + 1, "continue")
+                self.emit(indent, "result = function(stack)")
+                self.emit(indent, "if result is not None:")
+                self.emit(indent + 1, "push(result)")
+            else:
+                self.emit(indent, "raise Exception({!r})".format("Unknown opcode: {}".format(self.program[i])))
+                break
+            i += 1
+        if len(self.lines) == emitted:
+            self.emit(indent, "pass")
+
+    def breaks_out_of_frame(self, i):
+        # A break outside any if/while ends the whole function or program
+        end = self.jumps[i]
+        return end == len(self.program) or self.program.ops[self.jumps[end]] == FUNCTION
+
+    def run(self):
+        namespace = {"functions": {}, "dump": output.dump}
+        exec(compile(self.source, "<slang>", "exec"), namespace)
+        try:
+            namespace["main"]()
+        finally:
+            output.flush()
@@ -0,0 +1,43 @@
+import asyncio
+
+import output
+from interpreter import VM
+
+# Steps a program runs before the others get a turn
+SLICE_STEPS = 1000
+
+async def execute(vm, budget=SLICE_STEPS, limit=None):
+    # Runs vm to the end in slices of budget steps, letting every other task
+    # on the event loop run between them. A program still running after
+    # limit steps is stopped.
+    while not vm.run(budget):
+        if limit is not None and vm.steps >= limit:
+            vm.output.flush()
+            raise Exception("Program did not finish within {} steps".format(limit))
+        await asyncio.sleep(0)
+    return vm.stack
+
+async def run_program(program, out, budget, limit):
+    # A program that fails, even before it starts, fails on its own
+    vm = None
+    try:
+        vm = VM(program, out=out)
+        await execute(vm, budget, limit)
+        return vm.stack, None
+    except Exception as e:
+        return [] if vm is None else vm.stack, e
+
+async def run_programs(programs, budget=SLICE_STEPS, limit=None):
+    # Runs all programs interleaved, each with its own stack and output.
+    # Returns (output, stack, error) for each program, in order.
+    outputs = []
+    tasks = []
+    for program in programs:
+        chunks = []
+        outputs.append(chunks)
+        tasks.append(run_program(program, output.Output(chunks.append), budget, limit))
+    results = await asyncio.gather(*tasks)
+    return [("".join(chunks), stack, error) for chunks, (stack, error) in zip(outputs, results)]
+
+def run(programs, budget=SLICE_STEPS, limit=None):
+    return asyncio.run(run_programs(programs, budget, limit))
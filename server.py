@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import stat
+import socket
+import signal
+import struct
+import tempfile
+import traceback
+
+import output
+
+# Largest request a client may send
+MAX_REQUEST = 1 << 16
+
+def default_socket_path():
+    if "SLANG_SOCKET" in os.environ:
+        return os.environ["SLANG_SOCKET"]
+    # A directory only this user can reach, so nobody else can put
+    # anything at the socket's path
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), "slang-{}".format(os.getuid()))
+    return os.path.join(directory, "slang.sock")
+
+def peer_uid(connection):
+    _, uid, _ = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+def check_directory(directory):
+    # Others must not be able to replace what is in the socket's directory:
+    # it has to be this user's and writable only by them, or sticky like /tmp
+    if not os.path.exists(directory):
+        os.mkdir(directory, 0o700)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise Exception("{} is not a directory".format(directory))
+    private = info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    if not private and not info.st_mode & stat.S_ISVTX:
+        raise Exception("{} can be changed by other users".format(directory))
+
+def remove_stale_socket(path):
+    # Only a socket of this user's that nothing listens on any more is
+    # removed; anything else at the path is left alone
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        raise Exception("{} exists and is not a slang server socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Exception("A server is already listening on {}".format(path))
+
+def warm_up():
+    # Everything a request could need is loaded once here, and every request
+    # runs in a fork of this process, so it starts with LLVM initialized, the
+    # target machines created and the compile cache's fingerprint computed
+    import pyjit
+    import profiler
+    try:
+        import vectorized
+    except ImportError:
+        pass
+
+    try:
+        import compiler
+        import cache
+    except ImportError:
+        return
+    for opt_level in range(4):
+        compiler.target_machine(opt_level)
+    cache.compiler_fingerprint()
+
+def send(connection, message):
+    connection.sendall((json.dumps(message) + "\n").encode())
+
+def handle(connection, main):
+    # A request is the client's arguments and working directory along with
+    # its stdin, stdout and stderr, so the program reads and writes the
+    # client's terminal directly
+    uid = peer_uid(connection)
+    if uid != os.getuid():
+        raise Exception("Refused a request from uid {}".format(uid))
+    data, fds, _, _ = socket.recv_fds(connection, MAX_REQUEST, 3)
+    if not data and not fds:
+        # Somebody checking whether a server is listening
+        return
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        raise Exception("Expected 3 file descriptors, got {}".format(len(fds)))
+    request = json.loads(data.decode())
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        for fd in fds:
+            os.close(fd)
+        return
+
+    status = 1
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        # The server's own handlers would hide the exit status of clang
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        send(connection, {"pid": os.getpid()})
+
+        sys.argv = ["slang.py"] + request["argv"]
+        try:
+            main()
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+        except KeyboardInterrupt:
+            status = 130
+        except Exception:
+            traceback.print_exc()
+        output.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        send(connection, {"status": status})
+    finally:
+        os._exit(status)
+
+def serve(path, main):
+    warm_up()
+
+    check_directory(os.path.dirname(os.path.abspath(path)))
+    remove_stale_socket(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The socket is created readable and writable only by this user
+    umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    bound = os.lstat(path)
+    listener.listen()
+    # Finished requests are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("slang server listening on {}".format(path), file=sys.stderr)
+
+    try:
+        while True:
+            connection, _ = listener.accept()
+            try:
+                handle(connection, main)
+            except Exception as e:
+                print("slang server: {}".format(e), file=sys.stderr)
+            finally:
+                connection.close()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        listener.close()
+        # Unless something else has taken the path since
+        try:
+            info = os.lstat(path)
+        except FileNotFoundError:
+            pass
+        else:
+            if (info.st_dev, info.st_ino) == (bound.st_dev, bound.st_ino):
+                os.unlink(path)
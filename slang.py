@@ -1,26 +1,277 @@
+import os
 import sys
+import time
 
 sys.path.append('includes')
 
+# The backends and llvmlite are imported by the modes that use them, so
+# interpreting a program does not pay for loading LLVM
 from definitions import *
+from bytecode import load_program
 from interpreter import simulate
-from compiler import Codegen
+from optimizer import optimize, format_report
+
+def prepare_program(file_name):
+    program = load_program(file_name)
+    if "--no-peephole" not in sys.argv:
+        program, report = optimize(program)
+        if "--peephole-report" in sys.argv:
+            print(format_report(report), file=sys.stderr)
+    return program
+
+def stack_options():
+    # Keyword arguments for Codegen's operand stack
+    options = {
+        "growable": "--grow-stack" in sys.argv,
+        "checked": "--no-stack-checks" not in sys.argv,
+    }
+    if "--stack-size" in sys.argv:
+        options["stack_size"] = int(sys.argv[sys.argv.index("--stack-size") + 1])
+    return options
+
+def link_options():
+    # Keyword arguments for how Codegen links executables
+    options = {"static": "--dynamic" not in sys.argv}
+    if "--linker" in sys.argv:
+        options["linker"] = sys.argv[sys.argv.index("--linker") + 1]
+    return options
+
+def compile_file(file_name, output_file, opt_level=0, dump_ir=None):
+    # Returns the seconds each build phase took, or None when the executable
+    # came from the cache
+    with open(file_name, "rb") as f:
+        source = f.read()
+
+    from compiler import Codegen
+    from cache import CompileCache
+
+    # Reuse the executable from an earlier build of the same source.
+    # Dumping IR needs a real build, so it bypasses the cache.
+    cache = None if "--no-cache" in sys.argv or dump_ir is not None else CompileCache()
+    if cache is not None:
+        options = ["-O{}".format(opt_level)]
+        for flag in ("--no-peephole", "--grow-stack", "--no-stack-checks", "--incremental", "--dynamic"):
+            if flag in sys.argv:
+                options.append(flag)
+        if "--stack-size" in sys.argv:
+            options.append("--stack-size={}".format(sys.argv[sys.argv.index("--stack-size") + 1]))
+        key = cache.key(source, options)
+        if cache.fetch(key, output_file):
+            return None
+
+    # Incremental builds only rebuild the functions whose code changed,
+    # at the price of optimizing every function on its own
+    function_cache = None
+    if cache is not None and "--incremental" in sys.argv:
+        function_cache = cache.functions()
+
+    program = prepare_program(file_name)
+    codegen = Codegen(output_file, program, opt_level, dump_ir, function_cache=function_cache,
+                      **stack_options(), **link_options())
+    if cache is not None:
+        cache.store(key, output_file)
+    return codegen.timings
+
+def format_timings(timings):
+    return " ".join("{} {:.3f}s".format(phase, timings[phase]) for phase in timings)
+
+def batch_job(file_name, output_file, opt_level):
+    start = time.perf_counter()
+    timings = None
+    error = None
+    try:
+        timings = compile_file(file_name, output_file, opt_level)
+    except Exception as e:
+        error = str(e)
+    return file_name, output_file, time.perf_counter() - start, timings, error
+
+def batch_sources(paths, out_dir):
+    # Pairs every source with the path of its executable: the source's name
+    # without the extension, under out_dir if one is given. Sources found in
+    # a directory keep their place relative to it. A source without an
+    # extension gets .out added instead, so linking does not overwrite it.
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    if name.endswith(".slang"):
+                        sources.append((os.path.join(root, name), path))
+        else:
+            sources.append((path, os.path.dirname(path)))
+
+    jobs = []
+    for source, root in sources:
+        output_file = os.path.splitext(source)[0]
+        if out_dir is not None:
+            output_file = os.path.join(out_dir, os.path.relpath(output_file, root))
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        if os.path.abspath(output_file) == os.path.abspath(source):
+            output_file += ".out"
+        jobs.append((source, output_file))
+    return jobs
+
+def compile_batch(paths, out_dir, opt_level, workers):
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = batch_sources(paths, out_dir)
+    failed = 0
+    total = 0.0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(batch_job, file_name, output_file, opt_level) for file_name, output_file in jobs]
+        for future in futures:
+            file_name, output_file, seconds, timings, error = future.result()
+            total += seconds
+            if error is not None:
+                failed += 1
+                print("{:>8.3f}s  {}: {}".format(seconds, file_name, error), file=sys.stderr)
+            elif timings is None:
+                print("{:>8.3f}s  {} -> {} (cached)".format(seconds, file_name, output_file))
+            else:
+                print("{:>8.3f}s  {} -> {} ({})".format(seconds, file_name, output_file, format_timings(timings)))
+
+    print("{} files in {:.3f}s ({:.3f}s of compile time, {} failed)".format(
+        len(jobs), time.perf_counter() - start, total, failed))
+    return 1 if failed else 0
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        import server
+        socket_path = server.default_socket_path()
+        if "--socket" in sys.argv:
+            socket_path = sys.argv[sys.argv.index("--socket") + 1]
+        server.serve(socket_path, main)
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        # Every argument up to the first option is a source or a directory
+        paths = []
+        for arg in sys.argv[2:]:
+            if arg.startswith("-"):
+                break
+            paths.append(arg)
+
+        opt_level = 0
+        for arg in sys.argv[2:]:
+            if arg in ("-O0", "-O1", "-O2", "-O3"):
+                opt_level = int(arg[2])
+
+        out_dir = None
+        if "--out-dir" in sys.argv:
+            out_dir = sys.argv[sys.argv.index("--out-dir") + 1]
+
+        workers = None
+        if "--jobs" in sys.argv:
+            workers = int(sys.argv[sys.argv.index("--jobs") + 1])
+
+        sys.exit(compile_batch(paths, out_dir, opt_level, workers))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--schedule":
+        import scheduler
+        file_names = []
+        for arg in sys.argv[2:]:
+            if arg.startswith("-"):
+                break
+            file_names.append(arg)
+
+        budget = scheduler.SLICE_STEPS
+        if "--slice" in sys.argv:
+            budget = int(sys.argv[sys.argv.index("--slice") + 1])
+
+        limit = None
+        if "--limit" in sys.argv:
+            limit = int(sys.argv[sys.argv.index("--limit") + 1])
+
+        # A file that cannot be loaded is reported and the others still run
+        loaded = []
+        failed = 0
+        for file_name in file_names:
+            try:
+                loaded.append((file_name, prepare_program(file_name)))
+            except Exception as e:
+                # The loader's messages already name the file
+                print(e, file=sys.stderr)
+                failed += 1
+
+        results = scheduler.run([program for _, program in loaded], budget, limit)
+        for (file_name, _), (text, _, error) in zip(loaded, results):
+            print("==> {} <==".format(file_name))
+            sys.stdout.write(text)
+            if error is not None:
+                print("{}: {}".format(file_name, error), file=sys.stderr)
+                failed += 1
+        sys.exit(1 if failed else 0)
 
-if __name__ == "__main__":
     if len(sys.argv) < 3:
         print("Usage: python3 slang.py <file name> <mode> [other args....]")
+        print("       python3 slang.py <file name> --vector <file with one initial stack per line>")
+        print("       python3 slang.py <file name> --check")
+        print("       python3 slang.py --batch <files or directories...> [--out-dir <dir>] [--jobs <n>] [-O<n>]")
+        print("       python3 slang.py --schedule <files...> [--slice <steps>] [--limit <steps>]")
+        print("       python3 slang.py --serve [--socket <path>]")
         sys.exit(1)
 
     file_name = sys.argv[1]
     mode = sys.argv[2]
 
+    opt_level = 0
+    for arg in sys.argv[3:]:
+        if arg in ("-O0", "-O1", "-O2", "-O3"):
+            opt_level = int(arg[2])
+
+    dump_ir = None
+    if "--dump-ir" in sys.argv:
+        dump_ir = sys.argv[sys.argv.index("--dump-ir") + 1]
+
     if mode == "--intr":
-        program = tokenize_file(file_name)
-        simulate(program)
+        program = prepare_program(file_name)
+        if "--profile" in sys.argv or "--profile-json" in sys.argv:
+            from profiler import Profiler
+            profiler = Profiler(program, file_name)
+            try:
+                profiler.run()
+            finally:
+                print(profiler.report(), file=sys.stderr)
+                if "--profile-json" in sys.argv:
+                    profiler.write_json(sys.argv[sys.argv.index("--profile-json") + 1])
+        else:
+            simulate(program)
+    elif mode == "--vector":
+        # One run per line of the inputs file, which holds that run's
+        # initial stack; prints what each run dumped on its own line
+        from vectorized import simulate_batch
+        with open(sys.argv[3]) as f:
+            stacks = [[int(x) for x in line.split()] for line in f]
+        program = prepare_program(file_name)
+        _, outputs = simulate_batch(program, stacks)
+        for values in outputs:
+            print(" ".join(str(x) for x in values))
+    elif mode == "--check":
+        # Reports the stack analysis without running the program, failing
+        # when an instruction is certain to run out of values
+        from analyzer import StackAnalysis
+        analysis = StackAnalysis(prepare_program(file_name))
+        print(analysis.report(file_name))
+        sys.exit(1 if any(certain for certain, _ in analysis.problems.values()) else 0)
+    elif mode == "--pyjit":
+        from pyjit import PyCodegen
+        program = prepare_program(file_name)
+        PyCodegen(program).run()
+    elif mode == "--jit":
+        from compiler import Codegen
+        program = prepare_program(file_name)
+        sys.exit(Codegen(None, program, opt_level, dump_ir, **stack_options()).run_jit())
     elif mode == "--comp":
         output_file = "a.out"
         if "--out" in sys.argv:
             output_file = sys.argv[sys.argv.index("--out") + 1]
 
-        program = tokenize_file(file_name)
-        codegen = Codegen(output_file, program)
+        timings = compile_file(file_name, output_file, opt_level, dump_ir)
+        if "--timings" in sys.argv:
+            if timings is None:
+                print("cached", file=sys.stderr)
+            else:
+                print(format_timings(timings), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
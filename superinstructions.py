@@ -0,0 +1,186 @@
+import os
+import sys
+from array import array
+import definitions
+from definitions import *
+from bytecode import load
+from optimizer import optimize
+
+# Marks the first instruction of a fused run in the interpreter's copy of ops
+SUPER = 255
+
+MAX_LENGTH = 8
+TABLE_SIZE = 32
+TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fusion_table.py")
+
+CONDITIONS = {
+    IS_EQL: "==",
+    IS_NEQ: "!=",
+    IS_GRT: ">",
+    IS_LSS: "<",
+    IS_GEQ: ">=",
+    IS_LEQ: "<=",
+}
+
+# Straight-line opcodes a fused run can contain, as statements over the
+# interpreter's stack and args; {k} is the instruction's offset in the run
+SNIPPETS = {
+    PUSH: ["stack.append(args[i + {k}])"],
+    ADD_IMM: ["stack[-1] += args[i + {k}]"],
+    POP: ["stack.pop()"],
+    ADD: ["stack.append(stack.pop() + stack.pop())"],
+    SUB: ["stack.append(stack.pop() - stack.pop())"],
+    MUL: ["stack.append(stack.pop() * stack.pop())"],
+    DIV: ["stack.append(stack.pop() / stack.pop())"],
+    SWAP: ["stack[-1], stack[-2] = stack[-2], stack[-1]"],
+    ROT: ["stack[-1], stack[-2], stack[-3] = stack[-2], stack[-3], stack[-1]"],
+    OVER: ["stack.append(stack[-2])"],
+    DECREMENT: ["stack[-1] -= 1"],
+    INCREMENT: ["stack[-1] += 1"],
+    DUMP: ["out.dump(stack[-1])"],
+    DUP: ["stack.append(stack[-1])"],
+}
+
+def opcode_names():
+    return {getattr(definitions, name): name for name in dir(definitions)
+            if name.isupper() and isinstance(getattr(definitions, name), int)}
+
+def runs(ops):
+    # Yields (start, end) of every stretch a fused run may cover: an optional
+    # if/while header followed by straight-line opcodes. Nothing inside such
+    # a stretch is a jump target.
+    i = 0
+    while i < len(ops):
+        start = i
+        if ops[i] in (IF, WHILE) and i + 2 < len(ops) and ops[i + 1] in CONDITIONS and ops[i + 2] == DO:
+            i += 3
+        while i < len(ops) and ops[i] in SNIPPETS:
+            i += 1
+        if i == start:
+            i += 1
+        else:
+            yield start, i
+
+def windows(ops, start, end):
+    # Yields (position, window) for every sequence fuse() could match in a run
+    body = start + 3 if ops[start] in (IF, WHILE) else start
+    if body > start:
+        for n in range(3, MAX_LENGTH + 1):
+            if start + n > end:
+                break
+            yield start, tuple(ops[start:start + n])
+    for i in range(body, end):
+        for n in range(2, MAX_LENGTH + 1):
+            if i + n > end:
+                break
+            yield i, tuple(ops[i:i + n])
+
+def mine(files):
+    # Counts every fusable opcode sequence, weighting those inside loops by
+    # how deeply they are nested, as a stand-in for execution counts
+    counts = {}
+    for file_name in files:
+        program, _ = optimize(load(file_name))
+        ops = program.ops
+        jumps = link(ops)
+        weight = [1] * len(ops)
+        for i, op in enumerate(ops):
+            if op == WHILE:
+                for j in range(i + 1, jumps[i]):
+                    weight[j] *= 10
+
+        for start, end in runs(ops):
+            for i, window in windows(ops, start, end):
+                counts[window] = counts.get(window, 0) + weight[i + len(window) - 1]
+
+    # Each use of a fused run saves len - 1 dispatches. A window is left out
+    # when it only ever occurs inside one that was already picked.
+    ranked = sorted(counts, key=lambda window: (-counts[window] * (len(window) - 1), window))
+    table = []
+    for window in ranked:
+        if any(counts[chosen] >= counts[window] and contains(chosen, window) for chosen in table):
+            continue
+        table.append(window)
+        if len(table) == TABLE_SIZE:
+            break
+    return [(window, counts[window]) for window in table]
+
+def contains(window, part):
+    return any(window[i:i + len(part)] == part for i in range(len(window) - len(part) + 1))
+
+def write_table(table, file_count):
+    names = opcode_names()
+    with open(TABLE_FILE, "w") as f:
+        f.write("# Generated by superinstructions.py from {} file(s); do not edit.\n".format(file_count))
+        f.write("# Each entry is an opcode sequence the interpreter executes as one step.\n")
+        f.write("FUSIONS = [\n")
+        for window, count in table:
+            f.write("    ({}),  # {}\n".format(", ".join(repr(names[op]) for op in window), count))
+        f.write("]\n")
+
+def build_handler(window):
+    # out is the output.Output the running program prints to
+    lines = ["def handler(stack, args, jumps, i, out):"]
+    k = 0
+    if window[0] in (IF, WHILE):
+        lines.append("    if not (stack[-1] {} stack[-2]):".format(CONDITIONS[window[1]]))
+        lines.append("        return jumps[i] + 1")
+        k = 3
+    for op in window[k:]:
+        for snippet in SNIPPETS[op]:
+            lines.append("    " + snippet.format(k=k))
+        k += 1
+    lines.append("    return i + {}".format(len(window)))
+    namespace = {}
+    exec(compile("\n".join(lines) + "\n", "<superinstruction>", "exec"), namespace)
+    return namespace["handler"]
+
+def load_handlers():
+    try:
+        from fusion_table import FUSIONS
+    except ImportError:
+        return {}
+    handlers = {}
+    for names in FUSIONS:
+        window = tuple(getattr(definitions, name) for name in names)
+        handlers[window] = build_handler(window)
+    return handlers
+
+def fuse(ops, handlers):
+    # Returns a copy of ops with SUPER at the start of each fused run and a
+    # dict from those positions to their handlers, matching longest first
+    fused_ops = array('B', ops)
+    fused = {}
+    if not handlers:
+        return fused_ops, fused
+    lengths = sorted(set(len(window) for window in handlers), reverse=True)
+    for start, end in runs(ops):
+        i = start
+        while i < end:
+            for n in lengths:
+                if i + n <= end and tuple(ops[i:i + n]) in handlers:
+                    fused_ops[i] = SUPER
+                    fused[i] = handlers[tuple(ops[i:i + n])]
+                    i += n
+                    break
+            else:
+                # An unfused header is dispatched as a whole by the interpreter
+                i += 3 if i == start and ops[i] in (IF, WHILE) else 1
+    return fused_ops, fused
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 superinstructions.py <.slang file or directory> [...]")
+        sys.exit(1)
+
+    files = []
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names) if name.endswith(".slang")]
+        else:
+            files.append(path)
+
+    table = mine(files)
+    write_table(table, len(files))
+    print("Wrote {} superinstructions to {}".format(len(table), TABLE_FILE))
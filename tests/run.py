@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SLANG = os.path.join(HERE, "..", "slang.py")
+
+# Every program here has to print its .out file in each of its modes, and
+# the analysis of --check has to finish, whatever it reports. The modes are
+# the lines of the program's .modes file, or just --intr without one. A mode
+# that exits with an error adds "exit <status>" to what it printed.
+TIMEOUT = 30
+
+def run(file_name, args):
+    return subprocess.run([sys.executable, SLANG, file_name] + args,
+                          capture_output=True, text=True, timeout=TIMEOUT)
+
+def modes(file_name):
+    try:
+        with open(os.path.splitext(file_name)[0] + ".modes") as f:
+            return [line.split() for line in f if line.strip()]
+    except FileNotFoundError:
+        return [["--intr"]]
+
+def check(file_name):
+    with open(os.path.splitext(file_name)[0] + ".out") as f:
+        expected = f.read()
+    try:
+        for args in modes(file_name):
+            result = run(file_name, args)
+            printed = result.stdout
+            if result.returncode != 0:
+                printed += "exit {}\n".format(result.returncode)
+            if printed != expected:
+                return "{}: expected {!r}, got {!r}{}".format(" ".join(args), expected, printed, result.stderr)
+        run(file_name, ["--check"])
+    except subprocess.TimeoutExpired as e:
+        return "{} did not finish within {}s".format(" ".join(e.cmd[3:]), TIMEOUT)
+    return None
+
+if __name__ == "__main__":
+    failed = 0
+    for name in sorted(os.listdir(HERE)):
+        if not name.endswith(".slang"):
+            continue
+        error = check(os.path.join(HERE, name))
+        if error is None:
+            print("ok    {}".format(name))
+        else:
+            print("FAIL  {}: {}".format(name, error))
+            failed += 1
+    sys.exit(1 if failed else 0)
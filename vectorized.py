@@ -0,0 +1,305 @@
+import numpy as np
+from definitions import *
+from bytecode import assemble, tail_calls
+from analyzer import StackAnalysis
+
+CONDITIONS = {
+    IS_EQL: np.equal,
+    IS_NEQ: np.not_equal,
+    IS_GRT: np.greater,
+    IS_LSS: np.less,
+    IS_GEQ: np.greater_equal,
+    IS_LEQ: np.less_equal,
+}
+
+class Lanes:
+    # Runs one program over many initial stacks at once. Slot k of every
+    # lane's stack is row k of values, and each lane has its own stack
+    # pointer, so lanes may reach different depths. Opcodes work on whole
+    # rows; an if or while runs its body once for all lanes whose condition
+    # holds, masking out the rest, until no lane is left in the loop. Once a
+    # value is a float, as any quotient is, floats marks the slots holding
+    # one, so the others still come out as integers like in simulate.
+    def __init__(self, program, stacks):
+        self.program = assemble(program)
+        self.ops = self.program.ops
+        self.args = self.program.args
+        self.consts = self.program.consts
+        self.jumps = link(self.ops)
+        self.tails = tail_calls(self.program, self.jumps)
+        self.functions = {}
+
+        count = len(stacks)
+        depths = [len(stack) for stack in stacks]
+        depth = max(depths, default=0)
+
+        # A program that cannot run short of values needs no checks, and one
+        # whose deepest point is known gets every row it uses up front
+        analysis = StackAnalysis(self.program, (min(depths, default=0), depth))
+        self.checked = not analysis.safe()
+        peak = analysis.peak()
+        self.growable = peak is None
+
+        rows = 2 * depth + 16 if peak is None else max(peak, 1)
+        self.values = np.zeros((rows, count), dtype=np.int64)
+        self.floats = None
+        if any(isinstance(x, float) for stack in stacks for x in stack):
+            self.use_floats()
+        for lane, stack in enumerate(stacks):
+            self.values[:len(stack), lane] = stack
+            if self.floats is not None:
+                self.floats[:len(stack), lane] = [isinstance(x, float) for x in stack]
+        self.sp = np.array([len(stack) for stack in stacks], dtype=np.int64)
+        self.lanes = np.arange(count)
+        # (lanes, values, kinds) for every DUMP, in order
+        self.dumps = []
+
+    def reserve(self, n):
+        if not self.growable:
+            return
+        rows = len(self.values)
+        if len(self.lanes) and self.sp.max() + n > rows:
+            extra = np.zeros((max(rows, n), len(self.lanes)), dtype=self.values.dtype)
+            self.values = np.concatenate([self.values, extra])
+            if self.floats is not None:
+                self.floats = np.concatenate([self.floats, extra.astype(bool)])
+
+    def use_floats(self):
+        if self.floats is None:
+            self.values = self.values.astype(np.float64)
+            self.floats = np.zeros(self.values.shape, dtype=bool)
+
+    def require(self, active, base, n, message="Stack underflow"):
+        if not self.checked:
+            return
+        short = active & (self.sp - base < n)
+        if short.any():
+            raise Exception("{} in lane {}".format(message, np.argmax(short)))
+
+    def top(self, k=1):
+        # Reads every lane; lanes too shallow for it read garbage, which the
+        # callers only ever store into lanes that are deep enough
+        return self.values[self.sp - k, self.lanes]
+
+    def kind(self, k=1):
+        # Which lanes hold a float at depth k, or None while no value is one
+        if self.floats is None:
+            return None
+        return self.floats[self.sp - k, self.lanes]
+
+    def put(self, active, k, x, kind=None):
+        if isinstance(x, np.ndarray):
+            x = x[active]
+        self.values[(self.sp - k)[active], self.lanes[active]] = x
+        if self.floats is not None:
+            if isinstance(kind, np.ndarray):
+                kind = kind[active]
+            self.floats[(self.sp - k)[active], self.lanes[active]] = False if kind is None else kind
+
+    def push(self, active, x, kind=None):
+        self.reserve(1)
+        self.put(active, 0, x, kind)
+        self.sp += active
+
+    def pop(self, active):
+        x = self.top()
+        self.sp -= active
+        return x
+
+    def condition(self, i, active, base):
+        op = self.ops[i + 1]
+        if op not in CONDITIONS:
+            raise Exception("Unknown condition opcode: {}".format(self.program[i + 1]))
+        self.require(active, base, 2)
+        return CONDITIONS[op](self.top(1), self.top(2))
+
+    def call(self, name, active, base):
+        # Runs the function called name for the lanes in active, on the frame
+        # at base, and returns the lanes that left it through a return. A
+        # call that is the last step of a function reuses the frame and runs
+        # here once the function is done, so recursion like this takes no
+        # Python stack; the result of one before the end is dropped, as in
+        # simulate.
+        returned = np.zeros(len(self.lanes), dtype=bool)
+        calls = [(name, active, False)]
+        while calls:
+            name, active, drops = calls.pop()
+            body, body_end, _ = self.functions[name]
+            tails = []
+            left = self.run(body, body_end, active.copy(), base, True, tails)
+            for callee, lanes, dropped in tails:
+                left &= ~lanes
+                calls.append((callee, lanes, drops or dropped))
+            if not drops:
+                returned |= left
+        return returned
+
+    def run(self, start, end, active, base, in_function, tails=None):
+        # Runs [start, end) for the lanes in active and returns the lanes
+        # that left their function through a return or a tail call, which
+        # is added to tails
+        returned = np.zeros(len(self.lanes), dtype=bool)
+        ops = self.ops
+        i = start
+        while i < end and active.any():
+            op = ops[i]
+            if op == PUSH:
+                self.push(active, self.args[i])
+            elif op == PUSH_CONST:
+                self.push(active, self.consts[self.args[i]])
+            elif op == POP:
+                self.require(active, base, 1)
+                self.pop(active)
+            elif op in (ADD, SUB, MUL, DIV):
+                self.require(active, base, 2)
+                kind = self.kind(1)
+                if kind is not None:
+                    kind = kind | self.kind(2)
+                top = self.pop(active)
+                second = self.pop(active)
+                if op == ADD:
+                    self.push(active, top + second, kind)
+                elif op == SUB:
+                    self.push(active, top - second, kind)
+                elif op == MUL:
+                    self.push(active, top * second, kind)
+                else:
+                    # Division is true division as in simulate
+                    zero = active & (second == 0)
+                    if zero.any():
+                        raise ZeroDivisionError("Division by zero in lane {}".format(np.argmax(zero)))
+                    self.use_floats()
+                    self.push(active, top / second, True)
+            elif op == ADD_IMM or op == INCREMENT or op == DECREMENT:
+                self.require(active, base, 1)
+                step = self.args[i] if op == ADD_IMM else (1 if op == INCREMENT else -1)
+                self.put(active, 1, self.top() + step, self.kind())
+            elif op == DUP:
+                self.require(active, base, 1)
+                self.push(active, self.top(), self.kind())
+            elif op == OVER:
+                self.require(active, base, 2)
+                self.push(active, self.top(2), self.kind(2))
+            elif op == SWAP:
+                self.require(active, base, 2)
+                top, second = self.top(1), self.top(2)
+                top_kind, second_kind = self.kind(1), self.kind(2)
+                self.put(active, 1, second, second_kind)
+                self.put(active, 2, top, top_kind)
+            elif op == ROT:
+                self.require(active, base, 3)
+                top, second, third = self.top(1), self.top(2), self.top(3)
+                top_kind, second_kind, third_kind = self.kind(1), self.kind(2), self.kind(3)
+                self.put(active, 3, top, top_kind)
+                self.put(active, 2, third, third_kind)
+                self.put(active, 1, second, second_kind)
+            elif op == FLIP:
+                self.require(active, base, 2, "Not enough values on the stack to flip")
+                top, bottom = self.top(), self.values[base, self.lanes]
+                top_kind = self.kind()
+                bottom_kind = None if self.floats is None else self.floats[base, self.lanes]
+                self.values[base[active], self.lanes[active]] = top[active]
+                if self.floats is not None:
+                    self.floats[base[active], self.lanes[active]] = top_kind[active]
+                self.put(active, 1, bottom, bottom_kind)
+            elif op == DUMP:
+                self.require(active, base, 1)
+                kind = self.kind()
+                self.dumps.append((self.lanes[active], self.top()[active], None if kind is None else kind[active]))
+            elif op == IF:
+                inner = self.run(i + 3, self.jumps[i], active & self.condition(i, active, base), base, in_function, tails)
+                returned |= inner
+                active = active & ~inner
+                i = self.jumps[i]
+            elif op == WHILE:
+                running = active
+                while True:
+                    running = running & self.condition(i, running, base)
+                    if not running.any():
+                        break
+                    inner = self.run(i + 3, self.jumps[i], running, base, in_function, tails)
+                    returned |= inner
+                    active = active & ~inner
+                    running = running & ~inner
+                i = self.jumps[i]
+            elif op == BREAK:
+                # Every lane still running reaches the break together
+                break
+            elif op == RETURN:
+                if not in_function:
+                    raise Exception("Return outside of function")
+                self.require(active, base, 1, "Stack underflow in function")
+                value, kind = self.top(), self.kind()
+                self.values[base[active], self.lanes[active]] = value[active]
+                if self.floats is not None:
+                    self.floats[base[active], self.lanes[active]] = kind[active]
+                self.sp[active] = base[active] + 1
+                return returned | active
+            elif op == FUNCTION:
+                name, argcount = self.consts[self.args[i]]
+                self.functions[name] = (i + 2, self.jumps[i], argcount)
+                i = self.jumps[i]
+            elif op == CALL:
+                name = self.consts[self.args[i]]
+                if name not in self.functions:
+                    raise Exception("Function {} not found".format(name))
+                argcount = self.functions[name][2]
+                self.require(active, base, argcount, "Not enough arguments for function {}".format(name))
+
+                if tails is not None and i in self.tails:
+                    # The arguments replace the frame, reversed as below
+                    arguments = [(self.top(k + 1), self.kind(k + 1)) for k in range(argcount)]
+                    for k, (x, kind) in enumerate(arguments):
+                        self.values[(base + k)[active], self.lanes[active]] = x[active]
+                        if self.floats is not None:
+                            self.floats[(base + k)[active], self.lanes[active]] = kind[active]
+                    self.sp[active] = (base + argcount)[active]
+                    tails.append((name, active.copy(), self.tails[i]))
+                    return returned | active
+
+                # The arguments become the bottom of the callee's frame,
+                # reversed so the caller's top is at the bottom
+                callee_base = self.sp - argcount
+                for k in range(argcount // 2):
+                    low = (callee_base + k)[active]
+                    high = (self.sp - 1 - k)[active]
+                    lanes = self.lanes[active]
+                    self.values[low, lanes], self.values[high, lanes] = self.values[high, lanes], self.values[low, lanes]
+                    if self.floats is not None:
+                        self.floats[low, lanes], self.floats[high, lanes] = self.floats[high, lanes], self.floats[low, lanes]
+
+                returning = self.call(name, active, callee_base)
+                ended = active & ~returning
+                short = ended & (self.sp < callee_base)
+                if short.any():
+                    raise Exception("Stack underflow in function in lane {}".format(np.argmax(short)))
+                self.sp[ended] = callee_base[ended]
+            elif op != END:
+                raise Exception("Unknown opcode: {}".format(self.program[i]))
+            i += 1
+        return returned
+
+    def stacks(self):
+        return [numbers(self.values[:self.sp[lane], lane], None if self.floats is None else self.floats[:self.sp[lane], lane])
+                for lane in self.lanes]
+
+    def outputs(self):
+        outputs = [[] for _ in self.lanes]
+        for lanes, values, kinds in self.dumps:
+            for lane, value in zip(lanes.tolist(), numbers(values, kinds)):
+                outputs[lane].append(value)
+        return outputs
+
+def numbers(values, kinds):
+    # Python numbers for values, with those not marked in kinds as integers
+    if kinds is None:
+        return values.tolist()
+    return [x if floating else int(x) for x, floating in zip(values.tolist(), kinds.tolist())]
+
+def simulate_batch(program, stacks):
+    # Returns the final stack and the values printed by DUMP of every lane.
+    # Values are 64-bit, so unlike simulate large results wrap around.
+    machine = Lanes(program, stacks)
+    with np.errstate(all="ignore"):
+        machine.run(0, len(machine.ops), np.ones(len(stacks), dtype=bool), np.zeros(len(stacks), dtype=np.int64), False)
+    return machine.stacks(), machine.outputs()